@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+"""
+anomalies.py
+Historical climatology, end-of-century slices and anomalies of the spatial products
+
+Author: Sandy Herho
+Email: sandy.herho@email.ucr.edu
+Date: 05/27/2024
+"""
+
+import argparse
+import os
+
+import xarray as xr
+
+import manifest
+from extract_data import DATA_VARS, FILE_VARS, OUTPUT_FORMATS, SCENARIOS, VARIABLE_PREFIXES, product_path
+
+# Year of the projected slice compared to the historical climatology
+YEAR = 2100
+
+def climatology_path(anom_path, prefix):
+    """
+    Build the path of the historical time mean of a variable, e.g. ph_his_mean.nc.
+    """
+    return f"{anom_path}/{prefix}_his_mean.nc"
+
+def slice_path(anom_path, prefix, scenario, year=YEAR):
+    """
+    Build the path of the projected slice of a variable, e.g. 2100_ph_ssp119.nc.
+    """
+    return f"{anom_path}/{year}_{prefix}_{scenario}.nc"
+
+def anomaly_path(anom_path, prefix, scenario):
+    """
+    Build the path of the anomaly of a projected slice from the historical climatology, e.g. ph_ssp119_anom.nc.
+    """
+    return f"{anom_path}/{prefix}_{scenario}_anom.nc"
+
+def open_product(save_path_processed, scenario, file_var, data_var, output_format='netcdf'):
+    """
+    Open the median product of a variable lazily, one dask chunk per time slice.
+
+    Returns:
+    - tuple (data, dataset): the dask-backed DataArray and the Dataset to close after use.
+    """
+    path, group = product_path(save_path_processed, scenario, file_var, 'med', output_format)
+    if output_format == 'zarr':
+        ds = xr.open_zarr(path, group=group)
+    else:
+        ds = xr.open_dataset(path, chunks={"time": 1})
+    return ds[data_var], ds
+
+def build_variable(file_var, data_var, save_path_processed, anom_path, year=YEAR, output_format='netcdf'):
+    """
+    Write the climatology, the projected slices and the anomalies of one variable.
+
+    The historical time mean is computed once and reused for every SSP. Each projection is read
+    lazily, so only its `year` slice is loaded, and its slice and anomaly are written in one pass.
+
+    Parameters:
+    - file_var: str, the variable name used in the input file names (e.g., 'Aragonite').
+    - data_var: str, the variable name inside the datasets (e.g., 'aragonite').
+    - save_path_processed: str, the directory holding the spatial products.
+    - anom_path: str, the directory receiving the anomaly products.
+    - year: int, the projected year.
+    - output_format: str, the storage of the spatial products, one of OUTPUT_FORMATS.
+    """
+    import dask
+
+    prefix = VARIABLE_PREFIXES[file_var]
+    historical, ds = open_product(save_path_processed, 'historical', file_var, data_var, output_format)
+    with ds:
+        climatology = historical.mean(dim="time").load()
+    climatology.to_netcdf(climatology_path(anom_path, prefix))
+
+    for scenario in SCENARIOS[1:]:
+        projection, ds = open_product(save_path_processed, scenario, file_var, data_var, output_format)
+        with ds:
+            projected = projection.sel(time=year)
+            dask.compute(projected.to_netcdf(slice_path(anom_path, prefix, scenario, year), compute=False),
+                         (projected - climatology).to_netcdf(anomaly_path(anom_path, prefix, scenario),
+                                                             compute=False))
+
+def anomaly_inputs(save_path_processed, output_format='netcdf'):
+    """
+    List the spatial products the anomaly products are computed from.
+    """
+    inputs = []
+    for file_var in FILE_VARS:
+        for scenario in SCENARIOS:
+            path, _ = product_path(save_path_processed, scenario, file_var, 'med', output_format)
+            if path not in inputs:
+                inputs.append(path)
+    return inputs
+
+def anomaly_outputs(anom_path, year=YEAR):
+    """
+    List the climatology, slice and anomaly products of all variables and scenarios.
+    """
+    paths = []
+    for prefix in VARIABLE_PREFIXES.values():
+        paths.append(climatology_path(anom_path, prefix))
+        for scenario in SCENARIOS[1:]:
+            paths += [slice_path(anom_path, prefix, scenario, year), anomaly_path(anom_path, prefix, scenario)]
+    return paths
+
+def anomalies_up_to_date(save_path_processed, anom_path, year=YEAR, output_format='netcdf', method='hash'):
+    """
+    Check that the anomaly products exist and were built from the current spatial products.
+
+    The fingerprints of the inputs and outputs are recorded in `{anom_path}/manifest.json` by
+    build_anomalies, so products rewritten by extract_data make the anomalies stale.
+
+    Parameters:
+    - save_path_processed: str, the directory holding the spatial products.
+    - anom_path: str, the directory holding the anomaly products.
+    - year: int, the projected year.
+    - output_format: str, the storage of the spatial products, one of OUTPUT_FORMATS.
+    - method: str, the fingerprint method, one of manifest.FINGERPRINT_METHODS.
+
+    Returns:
+    - bool, True if the anomaly products do not need to be rebuilt.
+    """
+    records = manifest.load_manifest(f"{anom_path}/manifest.json")
+    return manifest.is_up_to_date(records.get('anomalies'), anomaly_inputs(save_path_processed, output_format),
+                                  anomaly_outputs(anom_path, year),
+                                  {'year': year, 'output_format': output_format}, method)
+
+def build_anomalies(save_path_processed, anom_path, year=YEAR, output_format='netcdf', method='hash'):
+    """
+    Write the anomaly products of all variables and record the products they were built from.
+    """
+    os.makedirs(anom_path, exist_ok=True)
+    manifest_path = f"{anom_path}/manifest.json"
+    # Forget the old record first, so an interrupted build cannot leave the products marked as current
+    records = manifest.load_manifest(manifest_path)
+    records.pop('anomalies', None)
+    manifest.save_manifest(records, manifest_path)
+
+    for file_var, data_var in zip(FILE_VARS, DATA_VARS):
+        build_variable(file_var, data_var, save_path_processed, anom_path, year, output_format)
+
+    records['anomalies'] = manifest.make_record(anomaly_inputs(save_path_processed, output_format),
+                                                anomaly_outputs(anom_path, year),
+                                                {'year': year, 'output_format': output_format}, method)
+    manifest.save_manifest(records, manifest_path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the climatology, slice and anomaly products.")
+    parser.add_argument("--year", type=int, default=YEAR, help="projected year compared to the climatology")
+    parser.add_argument("--format", dest="output_format", choices=OUTPUT_FORMATS, default='netcdf',
+                        help="storage of the spatial products written by extract_data")
+    args = parser.parse_args()
+    build_anomalies('../data/processed/spa', '../data/processed/spa_anom', args.year, args.output_format)
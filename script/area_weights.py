@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+"""
+area_weights.py
+Area-weighted regional means over the ocean cells of a grid
+
+Author: Sandy Herho
+Email: sandy.herho@email.ucr.edu
+Date: 05/06/2024
+"""
+
+import hashlib
+
+import numpy as np
+import xarray as xr
+
+# Weight kernels already built in this process, keyed by grid
+_KERNELS = {}
+
+class AreaWeights:
+    """
+    Cos-latitude weights restricted to the ocean cells of a grid.
+
+    Attributes:
+        weights (xarray.DataArray): Normalized (lat, lon) weights, zero over land.
+        ocean_mask (numpy.ndarray): Boolean (lat, lon) array, True for ocean cells.
+    """
+
+    def __init__(self, latitude, ocean_mask):
+        """
+        Builds the weights of a grid.
+
+        Parameters:
+            latitude (xarray.DataArray): Cell-center latitudes in degrees, with dims (lat, lon).
+            ocean_mask (numpy.ndarray): Boolean (lat, lon) array, True for ocean cells.
+        """
+        self.ocean_mask = np.asarray(ocean_mask, dtype=bool)
+        weights = np.cos(np.deg2rad(latitude.to_numpy())) * self.ocean_mask
+        self.weights = xr.DataArray(weights / weights.sum(), dims=latitude.dims)
+
+    def mean(self, data):
+        """
+        Computes the area-weighted mean over lat and lon.
+
+        Land cells carry no weight. Cells that are missing in a single time step are left out of that
+        time step and the remaining weights are renormalized. Works on numpy- and dask-backed data.
+
+        Parameters:
+            data (xarray.DataArray): Field with (lat, lon) dims and any leading dims.
+
+        Returns:
+            xarray.DataArray: The weighted mean, without the lat and lon dims.
+        """
+        dims = self.weights.dims
+        total = xr.dot(data.fillna(0), self.weights, dim=dims)
+        coverage = xr.dot(data.notnull(), self.weights, dim=dims)
+        return total / coverage
+
+def grid_key(latitude, ocean_mask):
+    """
+    Build a cache key identifying a grid by its shape, latitudes and ocean mask.
+    """
+    values = np.ascontiguousarray(latitude.to_numpy())
+    mask = np.packbits(np.asarray(ocean_mask, dtype=bool))
+    return latitude.shape, hashlib.sha1(values.tobytes()).hexdigest(), hashlib.sha1(mask.tobytes()).hexdigest()
+
+def get_area_weights(dataset, data_var):
+    """
+    Return the weight kernel of the grid of a dataset, building it on first use.
+
+    The ocean mask is taken from the cells of `data_var` that are valid in the first time step. Kernels
+    are cached per grid and mask, so products sharing the land mask reuse one kernel per process, while
+    a variable or file with a different mask gets its own.
+
+    Parameters:
+    - dataset: xarray Dataset with a 2D `latitude` variable.
+    - data_var: str, the variable whose first time step gives the ocean mask.
+
+    Returns:
+    - AreaWeights instance.
+    """
+    latitude = dataset["latitude"]
+    field = dataset[data_var]
+    if "time" in field.dims:
+        field = field.isel(time=0)
+    ocean_mask = field.notnull().to_numpy()
+    key = grid_key(latitude, ocean_mask)
+    if key not in _KERNELS:
+        _KERNELS[key] = AreaWeights(latitude, ocean_mask)
+    return _KERNELS[key]
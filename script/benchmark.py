@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+
+"""
+benchmark.py
+Offline benchmarks of the processing, statistics and rendering stages
+
+Author: Sandy Herho
+Email: sandy.herho@email.ucr.edu
+Date: 06/14/2024
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import extract_data
+from area_weights import AreaWeights
+from instrument import peak_rss_mb
+from rank_tests import rank_tests, spatial_rank_tests
+from spa_plot import render_maps
+from synthetic_data import SIZES, make_dataset
+from temporal_store import TemporalStore
+from trend_maps import trend_map
+
+def load_cube(workspace, scenario='ssp585', file_var='pHT', data_var='pHT'):
+    """
+    Load a full synthetic (time, lat, lon) cube and its latitudes.
+    """
+    with xr.open_dataset(f"{workspace}/acid/{scenario}/{file_var}_median_{scenario}.nc") as ds:
+        return ds[data_var].load(), ds['latitude'].load()
+
+def stage_extraction(workspace):
+    """
+    Subset, write and reduce all scenarios with extract_data.
+    """
+    for scenario in extract_data.SCENARIOS:
+        extract_data.process_and_save(scenario, f"{workspace}/acid", f"{workspace}/spa", f"{workspace}/temporal")
+
+def stage_area_mean(workspace):
+    """
+    Build the cos-latitude weights of the full grid and reduce a cube to its weighted ocean mean.
+    """
+    data, latitude = load_cube(workspace)
+    AreaWeights(latitude, data.isel(time=0).notnull().to_numpy()).mean(data).to_numpy()
+
+def stage_spatial_stats(workspace):
+    """
+    Compute the Sen slope and Mann-Kendall maps of a full cube.
+    """
+    data, _ = load_cube(workspace)
+    trend_map(data)
+
+def stage_rank_tests(workspace):
+    """
+    Run the temporal rank tests on the extracted series and the spatial rank tests on full grids.
+    """
+    store = TemporalStore(f"{workspace}/temporal")
+    rank_tests({column: store.series(column) for column in ('pH_med', 'aragonite_med', 'calcite_med')})
+    grids = [load_cube(workspace, scenario)[0].isel(time=-1).to_numpy() for scenario in extract_data.SCENARIOS[1:]]
+    spatial_rank_tests(grids, extract_data.SCENARIOS[1:], block=1)
+
+def stage_rendering(workspace):
+    """
+    Render the last time step of the extracted median products as maps.
+    """
+    jobs = []
+    for prefix in extract_data.VARIABLE_PREFIXES.values():
+        with xr.open_dataset(f"{workspace}/spa/ssp585_{prefix}_med.nc") as ds:
+            data = ds[list(ds.data_vars)[0]].isel(time=-1).to_numpy()
+        bounds = [np.linspace(-25, 29, data.shape[0]), np.linspace(95, 196, data.shape[1])]
+        jobs.append({'data': data, 'bounds': bounds, 'filename': f"{workspace}/figs/{prefix}.png",
+                     'label': prefix})
+    render_maps(jobs)
+
+# Stage name -> function of the workspace; later stages read the products of the extraction
+STAGES = {
+    'extraction': stage_extraction,
+    'area_mean': stage_area_mean,
+    'spatial_stats': stage_spatial_stats,
+    'rank_tests': stage_rank_tests,
+    'rendering': stage_rendering,
+}
+
+# Modules that are imported by other tools and must stay fast and free of side effects to import
+LIBRARY_MODULES = ['extract_data', 'area_weights', 'temporal_store', 'manifest', 'rank_tests', 'anomalies',
+                   'spa_plot', 'trend_maps', 'temp_stats', 'temp_plot', 'temporal_anal', 'pco2_scenarios',
+                   'monte_carlo', 'emulator', 'figure_cache', 'instrument', 'pipeline']
+
+# Plotting and statistics backends the library modules only load on first use
+LAZY_MODULES = ['matplotlib', 'seaborn', 'scipy.stats', 'statsmodels', 'scikit_posthocs', 'dask']
+
+def import_time(module, repeat=3):
+    """
+    Measure the import of a module in fresh interpreters with `python -X importtime`.
+
+    Parameters:
+    - module: str, the name of a module in this directory.
+    - repeat: int, the number of interpreters started.
+
+    Returns:
+    - dict with the cumulative import times in seconds, their minimum and median, and the names of
+      the LAZY_MODULES the import loaded.
+    """
+    seconds, loaded = [], set()
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                                capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        for line in result.stderr.splitlines():
+            fields = line.removeprefix('import time:').split('|')
+            if len(fields) != 3 or not fields[1].strip().isdigit():
+                continue
+            name = fields[2].strip()
+            if name == module:
+                seconds.append(int(fields[1]) / 1e6)
+            elif name in LAZY_MODULES:
+                loaded.add(name)
+    return {'seconds': seconds, 'min': min(seconds), 'median': float(np.median(seconds)),
+            'lazy_loaded': sorted(loaded)}
+
+def import_times(modules=LIBRARY_MODULES, repeat=3):
+    """
+    Measure the import of each module and report those that load a backend eagerly.
+
+    Returns:
+    - list of result dicts with the 'import' size, one per module.
+    """
+    results = []
+    for module in modules:
+        result = import_time(module, repeat)
+        results.append({'size': 'import', 'shape': None, 'stage': module, 'peak_mb': None, **result})
+        eager = f", loads {', '.join(result['lazy_loaded'])}" if result['lazy_loaded'] else ""
+        print(f"{'import':>8} {module:>14}: {result['median']:8.3f} s (min {result['min']:.3f} s){eager}")
+    return results
+
+def measure(stage, workspace, repeat=3):
+    """
+    Time a stage and record the peak memory allocated while it runs.
+
+    The timed runs are not traced; the peak allocation is measured in one extra run under tracemalloc,
+    which also sees the buffers allocated by NumPy.
+
+    Parameters:
+    - stage: function taking the workspace directory.
+    - workspace: str, the directory holding the synthetic inputs and the products.
+    - repeat: int, the number of timed runs.
+
+    Returns:
+    - dict with the run times in seconds, their minimum and median, and the peak traced allocation
+      in megabytes.
+    """
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        stage(workspace)
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        stage(workspace)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'seconds': seconds, 'min': min(seconds), 'median': float(np.median(seconds)),
+            'peak_mb': peak / 1024 ** 2}
+
+def environment():
+    """
+    Describe the commit and software the benchmarks ran with.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'numpy': np.__version__,
+            'xarray': xr.__version__, 'pandas': pd.__version__, 'platform': platform.platform(),
+            'cpus': os.cpu_count(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+def run(sizes, stages, repeat=3, seed=0):
+    """
+    Run the selected stages on synthetic inputs of each size.
+
+    Returns:
+    - dict with the 'environment' and one result per size and stage under 'results'.
+    """
+    results = []
+    for size in sizes:
+        workspace = tempfile.mkdtemp(prefix=f"bench_{size}_")
+        try:
+            make_dataset(f"{workspace}/acid", size, seed=seed)
+            for directory in ('spa', 'temporal', 'figs'):
+                os.makedirs(f"{workspace}/{directory}")
+            # The statistics and rendering stages read the products of the extraction
+            if 'extraction' not in stages:
+                stage_extraction(workspace)
+            for name in stages:
+                result = measure(STAGES[name], workspace, repeat)
+                results.append({'size': size, 'shape': list(SIZES[size]), 'stage': name, **result})
+                print(f"{size:>8} {name:>14}: {result['median']:8.3f} s (min {result['min']:.3f} s), "
+                      f"peak {result['peak_mb']:.1f} MB")
+        finally:
+            shutil.rmtree(workspace, ignore_errors=True)
+    return {'environment': dict(environment(), peak_rss_mb=peak_rss_mb()), 'results': results}
+
+def compare(baseline, current):
+    """
+    Tabulate the median times and peak memory of two result files side by side.
+
+    Returns:
+    - pandas DataFrame indexed by size and stage, with the ratios current / baseline.
+    """
+    columns = ['size', 'stage', 'median', 'peak_mb']
+    old = pd.DataFrame(baseline['results'])[columns].set_index(['size', 'stage'])
+    new = pd.DataFrame(current['results'])[columns].set_index(['size', 'stage'])
+    table = old.join(new, lsuffix='_baseline', rsuffix='_current', how='outer')
+    table['time_ratio'] = table['median_current'] / table['median_baseline']
+    table['memory_ratio'] = table['peak_mb_current'] / table['peak_mb_baseline']
+    return table
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic inputs.")
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=['small'], help="input sizes to run")
+    parser.add_argument("--stages", nargs="*", choices=list(STAGES), default=list(STAGES),
+                        help="stages to run; none with --imports to only measure the imports")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per stage")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic inputs")
+    parser.add_argument("--output", default=None,
+                        help="JSON file receiving the results (default: ../benchmarks/{commit}.json)")
+    parser.add_argument("--compare", metavar="JSON", default=None,
+                        help="earlier result file to compare the new results with")
+    parser.add_argument("--imports", action="store_true",
+                        help="also measure the import time of the library modules and fail if one loads "
+                             "a plotting or statistics backend at import")
+    args = parser.parse_args()
+
+    report = run(args.sizes if args.stages else [], args.stages, repeat=args.repeat, seed=args.seed)
+    if args.imports:
+        report['results'] += import_times(repeat=args.repeat)
+    output = args.output or f"../benchmarks/{report['environment']['commit'] or 'results'}.json"
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare(json.load(f), report).round(3).to_string())
+
+    eager = [result['stage'] for result in report['results'] if result.get('lazy_loaded')]
+    if eager:
+        raise SystemExit(f"{len(eager)} module(s) load a backend at import: {', '.join(eager)}")
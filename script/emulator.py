@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+"""
+emulator.py
+Per-grid-cell emulator of the carbonate chemistry as a function of atmospheric pCO2
+
+Author: Sandy Herho
+Email: sandy.herho@email.ucr.edu
+Date: 06/10/2024
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from area_weights import AreaWeights
+from extract_data import COLUMN_PREFIXES, DATA_VARS, FILE_VARS, SCENARIOS, WEIGHTINGS, product_path
+from pco2_scenarios import FORCING_CACHE, ScenarioMatrix
+
+# pCO2 pathway of each scenario in data/pre_processed/rf
+FORCING_FILES = {
+    'historical': 'historical.csv',
+    'ssp119': 'IMAGE_ssp119.csv',
+    'ssp126': 'IMAGE_ssp126.csv',
+    'ssp245': 'MASSAGE_GLOBIOM_ssp245.csv',
+    'ssp370': 'AIM_ssp370.csv',
+    'ssp585': 'REMIND_MAGPIE_ssp585.csv'
+}
+
+# Pre-industrial pCO2 in ppm; the predictor is ln(pCO2 / REFERENCE_PCO2)
+REFERENCE_PCO2 = 278.0
+
+def design_matrix(pco2, degree=2):
+    """
+    Build the regression terms 1, x, ..., x**degree of x = ln(pCO2 / REFERENCE_PCO2).
+
+    Parameters:
+    - pco2: 1D array-like of pCO2 values in ppm.
+    - degree: int, the degree of the polynomial.
+
+    Returns:
+    - 2D numpy array (observations, degree + 1).
+    """
+    return np.vander(np.log(np.asarray(pco2, dtype=float) / REFERENCE_PCO2), degree + 1, increasing=True)
+
+def fit_cells(design, values):
+    """
+    Fit the same regression terms to every grid cell with one least-squares solve.
+
+    The predictor is global, so all cells share the design matrix and are solved together as the
+    columns of one right-hand side. Cells with a missing value, e.g. land, get NaN coefficients.
+
+    Parameters:
+    - design: 2D numpy array (observations, terms).
+    - values: 2D numpy array (observations, cells).
+
+    Returns:
+    - 2D numpy array (terms, cells) of coefficients.
+    """
+    valid = ~np.isnan(values).any(axis=0)
+    coefficients = np.full((design.shape[1], values.shape[1]), np.nan)
+    coefficients[:, valid] = np.linalg.lstsq(design, values[:, valid], rcond=None)[0]
+    return coefficients
+
+class CarbonateEmulator:
+    """
+    Regression of pHT, aragonite and calcite saturation on ln(pCO2), fitted separately for each grid cell.
+
+    Attributes:
+        coefficients (xarray.Dataset): One (term, lat, lon) variable per data variable, with the 2D
+            `latitude` and `longitude` of the grid.
+        degree (int): The degree of the polynomial in ln(pCO2 / REFERENCE_PCO2).
+    """
+
+    def __init__(self, coefficients):
+        """
+        Initializes the emulator from fitted coefficients.
+        """
+        self.coefficients = coefficients
+        self.degree = coefficients.sizes['term'] - 1
+
+    @classmethod
+    def fit(cls, save_path_processed='../data/processed/spa', forcing_path='../data/pre_processed/rf',
+            degree=2, output_format='netcdf', cache_dir=FORCING_CACHE):
+        """
+        Fit the emulator to the median products of all scenarios.
+
+        Parameters:
+            save_path_processed (str): The directory holding the spatial products.
+            forcing_path (str): The directory holding the pCO2 CSV files.
+            degree (int): The degree of the polynomial in ln(pCO2). Default is 2.
+            output_format (str): The storage of the spatial products written by extract_data.
+            cache_dir (str): Directory of the columnar store of the pCO2 files, or None to parse them in memory.
+
+        Returns:
+            CarbonateEmulator: The fitted emulator.
+        """
+        forcing = ScenarioMatrix.from_files({scenario: f"{forcing_path}/{FORCING_FILES[scenario]}"
+                                             for scenario in SCENARIOS}, cache_dir=cache_dir)
+        coefficients = xr.Dataset()
+        for file_var, data_var in zip(FILE_VARS, DATA_VARS):
+            pco2, fields = [], []
+            for row, scenario in enumerate(SCENARIOS):
+                path, group = product_path(save_path_processed, scenario, file_var, 'med', output_format)
+                ds = xr.open_zarr(path, group=group) if output_format == 'zarr' else xr.open_dataset(path)
+                with ds:
+                    data = ds[data_var].load()
+                    if 'latitude' not in coefficients:
+                        coefficients['latitude'] = ds['latitude'].load()
+                        coefficients['longitude'] = ds['longitude'].load()
+                years = data['time'].to_numpy().round().astype(int)
+                pco2.append(forcing.values[row, np.searchsorted(forcing.years, years)])
+                fields.append(data.to_numpy().reshape(len(years), -1))
+
+            design = design_matrix(np.concatenate(pco2), degree)
+            result = fit_cells(design, np.concatenate(fields))
+            coefficients[data_var] = (('term', 'lat', 'lon'), result.reshape((degree + 1,) + data.shape[1:]))
+        coefficients.attrs['reference_pco2'] = REFERENCE_PCO2
+        coefficients.attrs['training_scenarios'] = ' '.join(SCENARIOS)
+        return cls(coefficients)
+
+    def save(self, path='../data/processed/emulator.nc'):
+        """
+        Saves the fitted coefficients to a NetCDF file.
+        """
+        self.coefficients.to_netcdf(path)
+
+    @classmethod
+    def load(cls, path='../data/processed/emulator.nc'):
+        """
+        Loads fitted coefficients from a NetCDF file.
+        """
+        with xr.open_dataset(path) as ds:
+            return cls(ds.load())
+
+    def project(self, years, pco2):
+        """
+        Projects the spatial fields of a pCO2 pathway.
+
+        Parameters:
+            years (array-like): The years of the pathway.
+            pco2 (array-like): The pCO2 in ppm for each year.
+
+        Returns:
+            xarray.Dataset: One (time, lat, lon) variable per data variable.
+        """
+        design = design_matrix(pco2, self.degree)
+        fields = xr.Dataset(coords={'time': np.asarray(years, dtype=float)})
+        for data_var in DATA_VARS:
+            coefficients = self.coefficients[data_var].to_numpy()
+            shape = coefficients.shape[1:]
+            values = design @ coefficients.reshape(self.degree + 1, -1)
+            fields[data_var] = (('time', 'lat', 'lon'), values.reshape((len(design),) + shape))
+        fields['latitude'] = self.coefficients['latitude']
+        fields['longitude'] = self.coefficients['longitude']
+        return fields
+
+    def regional_means(self, fields, weighting='none'):
+        """
+        Reduces projected fields to regional-mean time series, as in extract_data.
+
+        Parameters:
+            fields (xarray.Dataset): The fields returned by `project`.
+            weighting (str): The regional-mean reduction, one of WEIGHTINGS.
+
+        Returns:
+            pd.DataFrame: A 'time' column and one '{variable}_med' column per data variable.
+        """
+        series = {'time': fields['time'].to_numpy()}
+        for data_var in DATA_VARS:
+            data = fields[data_var]
+            if weighting == 'area':
+                mean = AreaWeights(fields['latitude'], data.isel(time=0).notnull().to_numpy()).mean(data)
+            else:
+                mean = data.mean(dim=['lat', 'lon'])
+            series[f"{COLUMN_PREFIXES.get(data_var, data_var)}_med"] = mean.to_numpy()
+        return pd.DataFrame(series)
+
+    def project_file(self, csv_path, min_year=None, max_year=2100):
+        """
+        Projects the pCO2 pathway of a CSV file in the data/pre_processed/rf format.
+
+        Returns:
+            xarray.Dataset: The fields returned by `project`.
+        """
+        forcing = ScenarioMatrix.from_files({'pathway': csv_path}, min_year=min_year, max_year=max_year)
+        return self.project(forcing.years, forcing.values[0])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit the pCO2 emulator or project a new pCO2 pathway.")
+    parser.add_argument("--fit", action="store_true", help="fit the emulator to the spatial products")
+    parser.add_argument("--degree", type=int, default=2, help="degree of the polynomial in ln(pCO2)")
+    parser.add_argument("--project", metavar="CSV", nargs="*", default=[],
+                        help="pCO2 pathways to project, in the data/pre_processed/rf CSV format")
+    parser.add_argument("--max-year", type=int, default=2100, help="last year of the projections")
+    parser.add_argument("--weighting", choices=WEIGHTINGS, default='none',
+                        help="regional-mean reduction: plain lat/lon mean or area-weighted ocean mean")
+    args = parser.parse_args()
+
+    coefficients_path = '../data/processed/emulator.nc'
+    output_path = '../data/processed/emulated'
+    if args.fit or not os.path.exists(coefficients_path):
+        emulator = CarbonateEmulator.fit(degree=args.degree)
+        emulator.save(coefficients_path)
+    else:
+        emulator = CarbonateEmulator.load(coefficients_path)
+
+    os.makedirs(output_path, exist_ok=True)
+    for csv_path in args.project:
+        start = time.perf_counter()
+        fields = emulator.project_file(csv_path, max_year=args.max_year)
+        series = emulator.regional_means(fields, args.weighting)
+        print(f"Projected {csv_path} in {time.perf_counter() - start:.3f} s")
+        name = os.path.splitext(os.path.basename(csv_path))[0]
+        fields.to_netcdf(f"{output_path}/{name}.nc")
+        series.to_csv(f"{output_path}/{name}.csv", index=False)
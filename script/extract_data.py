@@ -9,77 +9,763 @@ Email: sandy.herho@email.ucr.edu
 Date: 04/10/2024
 """
 
+import argparse
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
 import xarray as xr
 import pandas as pd
 
-def load_and_select(filepath, lon_range, lat_range):
+import instrument
+import manifest
+import temporal_store
+from area_weights import get_area_weights
+
+# Variable names as they appear in the file names and inside the datasets
+FILE_VARS = ['pHT', 'Aragonite', 'Calcite']
+DATA_VARS = ['pHT', 'aragonite', 'calcite']
+
+# Output suffix -> statistic name used in the input file names
+STATISTICS = {'med': 'median', 'std': 'std'}
+
+SCENARIOS = ['historical', 'ssp119', 'ssp126', 'ssp245', 'ssp370', 'ssp585']
+
+# Short names used for the spatial products in data/processed/spa (e.g. his_ph_med.nc)
+SCENARIO_PREFIXES = {'historical': 'his'}
+VARIABLE_PREFIXES = {'pHT': 'ph', 'Aragonite': 'ar', 'Calcite': 'cal'}
+
+# Column names used in the temporal products (e.g. pH_med), where they differ from the data variable
+COLUMN_PREFIXES = {'pHT': 'pH'}
+
+# Output backends for the spatial products:
+# - netcdf: one uncompressed NetCDF file per variable and statistic
+# - netcdf-compressed: as above, float32 with zlib/shuffle, one chunk per time slice
+# - zarr: one Zarr store per scenario with a group per variable and statistic
+OUTPUT_FORMATS = ['netcdf', 'netcdf-compressed', 'zarr']
+
+# Regional-mean reductions: plain lat/lon mean, or cos-latitude weighted mean over ocean cells
+WEIGHTINGS = ['none', 'area']
+
+# Working precisions of the subsets, spatial products and regional means; sums are always taken in float64
+PRECISIONS = ['float64', 'float32']
+
+# Coral Triangle subset (index ranges of the global grid)
+LON_RANGE = (71, 172)
+LAT_RANGE = (65, 119)
+
+# Subsets the pipelined mode reads ahead of the computation, and spatial products it holds for writing
+PREFETCH = 2
+
+def load_and_select(filepath, lon_range, lat_range, time_chunk=None, precision='float64'):
     """
     Load a NetCDF file and select a subset of the data within the specified longitude and latitude ranges.
 
+    By default the subset is read into memory and the file is closed before returning. With
+    `time_chunk`, the subset stays lazy (dask-backed, `time_chunk` time steps per chunk) and the
+    file is closed when the returned Dataset is closed, e.g. by using it as a context manager.
+
     Parameters:
     - filepath: str, path to the NetCDF file.
     - lon_range: tuple, the longitude range to select.
     - lat_range: tuple, the latitude range to select.
+    - time_chunk: int, optional, number of time steps per chunk for lazy loading.
+    - precision: str, one of PRECISIONS, the dtype of the time-dependent variables. The latitudes and
+      longitudes keep their stored precision.
 
     Returns:
     - xarray Dataset with the selected subset of data.
     """
-    return xr.open_dataset(filepath).sel(lon=slice(*lon_range), lat=slice(*lat_range))
+    ds = xr.open_dataset(filepath, chunks={"time": time_chunk} if time_chunk else None)
+    subset = ds.sel(lon=slice(*lon_range), lat=slice(*lat_range))
+    subset = as_precision(subset, precision)
+    if time_chunk:
+        subset.set_close(ds.close)
+    else:
+        subset.load()
+        ds.close()
+    return subset
 
-def process_and_save(scenario, base_path, save_path_processed, save_path_temporal):
+def as_precision(data, precision='float64', block_bytes=1 << 26):
     """
-    Process and save the data for a given climate scenario by loading the data,
-    calculating the mean across specified dimensions, and saving the result to a CSV file.
+    Cast the time-dependent variables of a Dataset to one of PRECISIONS, leaving the others as stored.
+
+    Dask-backed variables are cast lazily. Other variables are read in blocks of time steps into an
+    array of the target dtype, so a float64 file is never held in memory next to its float32 copy.
+
+    Parameters:
+    - data: xarray Dataset, opened lazily or in memory.
+    - precision: str, one of PRECISIONS.
+    - block_bytes: int, the approximate number of bytes read at a time.
+
+    Returns:
+    - xarray Dataset with the cast variables.
+    """
+    for name in data.data_vars:
+        var = data[name]
+        if "time" not in var.dims or var.dtype == precision:
+            continue
+        if var.chunks is not None:
+            cast = var.astype(precision)
+        else:
+            values = np.empty(var.shape, dtype=precision)
+            axis = var.dims.index("time")
+            step = max(1, block_bytes // max(1, var.size // var.sizes["time"] * var.dtype.itemsize))
+            for start in range(0, var.sizes["time"], step):
+                index = (slice(None),) * axis + (slice(start, start + step),)
+                values[index] = var.isel(time=slice(start, start + step)).to_numpy()
+            cast = var.copy(data=values)
+        # Write the products in the working precision rather than the dtype of the source file
+        cast.encoding.pop("dtype", None)
+        data[name] = cast
+    return data
+
+def product_path(save_path_processed, scenario, file_var, stat, output_format='netcdf'):
+    """
+    Build the location of a spatial product.
+
+    Parameters:
+    - save_path_processed: str, the directory holding the processed spatial products.
+    - scenario: str, the name of the scenario (e.g., 'historical', 'ssp119').
+    - file_var: str, the variable name used in the input file names (e.g., 'Aragonite').
+    - stat: str, the statistic, 'med' or 'std'.
+    - output_format: str, one of OUTPUT_FORMATS.
+
+    Returns:
+    - tuple (path, group); group is None unless the product lives in a Zarr store.
+    """
+    scenario_prefix = SCENARIO_PREFIXES.get(scenario, scenario)
+    name = f"{VARIABLE_PREFIXES[file_var]}_{stat}"
+    if output_format == 'zarr':
+        return f"{save_path_processed}/{scenario_prefix}.zarr", name
+    return f"{save_path_processed}/{scenario_prefix}_{name}.nc", None
+
+def product_encoding(data, output_format):
+    """
+    Build the encoding for a spatial product.
+
+    The compressed backends store the time-dependent variables as float32, chunked so that
+    one time slice is one chunk and can be read without decompressing the rest of the cube.
+
+    Parameters:
+    - data: xarray Dataset to be written.
+    - output_format: str, one of OUTPUT_FORMATS.
+
+    Returns:
+    - dict with the encoding of each variable, or None to keep the source encoding.
+    """
+    if output_format == 'netcdf':
+        return None
+    encoding = {}
+    for name, var in data.data_vars.items():
+        if output_format == 'zarr':
+            encoding[name] = {}
+        else:
+            encoding[name] = {"zlib": True, "shuffle": True, "complevel": 4}
+        if "time" in var.dims:
+            chunks = tuple(1 if dim == "time" else size for dim, size in zip(var.dims, var.shape))
+            encoding[name]["dtype"] = "float32"
+            encoding[name]["chunks" if output_format == 'zarr' else "chunksizes"] = chunks
+    return encoding
+
+def write_product(data, save_path_processed, scenario, file_var, stat, output_format='netcdf',
+                  compute=True):
+    """
+    Write a spatial product with the chosen output backend.
+
+    Parameters:
+    - data: xarray Dataset to be written.
+    - save_path_processed: str, the directory to save the processed spatial products.
+    - scenario: str, the name of the scenario (e.g., 'historical', 'ssp119').
+    - file_var: str, the variable name used in the input file names (e.g., 'Aragonite').
+    - stat: str, the statistic, 'med' or 'std'.
+    - output_format: str, one of OUTPUT_FORMATS.
+    - compute: bool, if False return a dask delayed object instead of writing immediately.
+
+    Returns:
+    - dask delayed object if compute is False, otherwise None.
+    """
+    path, group = product_path(save_path_processed, scenario, file_var, stat, output_format)
+    encoding = product_encoding(data, output_format)
+    if output_format == 'zarr':
+        # Metadata is consolidated once per store, after all of its groups were written
+        return data.to_zarr(path, group=group, mode="w", encoding=encoding, consolidated=False,
+                            compute=compute)
+    return data.to_netcdf(path, encoding=encoding, compute=compute)
+
+def consolidate_store(save_path_processed, scenario):
+    """
+    Consolidate the metadata of the Zarr store of a scenario so readers open it with a single read.
+
+    Parameters:
+    - save_path_processed: str, the directory holding the processed spatial products.
+    - scenario: str, the name of the scenario (e.g., 'historical', 'ssp119').
+    """
+    import zarr
+
+    path, _ = product_path(save_path_processed, scenario, FILE_VARS[0], 'med', 'zarr')
+    zarr.consolidate_metadata(path)
+
+def input_path(base_path, scenario, file_var, stat):
+    """
+    Build the path of an input file, e.g. {base_path}/ssp119/pHT_median_ssp119.nc.
+    """
+    return f'{base_path}/{scenario}/{file_var}_{STATISTICS[stat]}_{scenario}.nc'
+
+def regional_mean(data, data_var, weighting='none'):
+    """
+    Reduce the subset of a variable to its regional-mean time series, one of WEIGHTINGS.
+
+    The sums are accumulated in float64 whatever the precision of the subset, and the series is
+    returned in the precision of the subset.
+    """
+    if weighting == 'area':
+        # The float64 weights promote the weighted sums
+        area_mean = get_area_weights(data, data_var).mean(data[data_var])
+    else:
+        area_mean = data[data_var].mean(dim=("lat", "lon"), dtype=np.float64)
+    return area_mean.astype(data[data_var].dtype)
+
+def extract_variable(scenario, file_var, data_var, stat, base_path, save_path_processed, time_chunk=None,
+                     output_format='netcdf', weighting='none', precision='float64'):
+    """
+    Extract a single (variable, statistic) file of a scenario: select the Coral Triangle subset,
+    save it as a spatial product and reduce it to a regional-mean time series.
 
     Parameters:
     - scenario: str, the name of the scenario to process (e.g., 'historical', 'ssp119').
+    - file_var: str, the variable name used in the file names (e.g., 'Aragonite').
+    - data_var: str, the variable name inside the dataset (e.g., 'aragonite').
+    - stat: str, the statistic to process, 'med' or 'std'.
     - base_path: str, the base directory containing the dataset.
     - save_path_processed: str, the directory to save the processed NetCDF files.
-    - save_path_temporal: str, the directory to save the summarized CSV files.
+    - time_chunk: int, optional, read the subset lazily in chunks of this many time steps.
+    - output_format: str, the backend used to write the spatial product, one of OUTPUT_FORMATS.
+    - weighting: str, the regional-mean reduction, one of WEIGHTINGS.
+    - precision: str, the working precision of the subset, its product and its mean, one of PRECISIONS.
+
+    Returns:
+    - tuple of numpy arrays (time, regional mean).
+    """
+    in_file = input_path(base_path, scenario, file_var, stat)
+    labels = {'scenario': scenario, 'variable': data_var, 'stat': stat}
+
+    with instrument.stage('open_select', 'extract_data', **labels):
+        data = load_and_select(in_file, LON_RANGE, LAT_RANGE, time_chunk=time_chunk, precision=precision)
+    with data:
+        area_mean = regional_mean(data, data_var, weighting)
+        if time_chunk:
+            import dask
+
+            # Write the subset and reduce it in the same pass over the chunks, so each
+            # chunk is read once and only a few chunks are held in memory at a time
+            write = write_product(data, save_path_processed, scenario, file_var, stat,
+                                  output_format, compute=False)
+            with instrument.stage('write_and_reduce', 'extract_data', **labels):
+                area_mean, _ = dask.compute(area_mean, write)
+        else:
+            # Save the spatial product after selection
+            with instrument.stage('write_product', 'extract_data', **labels):
+                write_product(data, save_path_processed, scenario, file_var, stat, output_format)
+        return data["time"].to_numpy(), area_mean.to_numpy()
+
+def prefetched(load, items, size=PREFETCH):
+    """
+    Yield (item, load(item)) for each item, loading up to `size` items ahead in a background thread.
+
+    The loaded values wait in a bounded queue, so at most `size` of them plus the one being loaded
+    are held in memory. An exception raised by `load` is re-raised by the generator.
+
+    Parameters:
+    - load: function of one item, e.g. reading a file.
+    - items: list of the items to load, in order.
+    - size: int, the number of loaded values the reader may run ahead.
+    """
+    buffer = queue.Queue(maxsize=size)
+    stop = threading.Event()
+
+    def read():
+        try:
+            for item in items:
+                if stop.is_set():
+                    return
+                buffer.put((item, load(item), None))
+        except Exception as exc:
+            buffer.put((None, None, exc))
+            return
+        buffer.put(None)
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    try:
+        while (entry := buffer.get()) is not None:
+            item, value, error = entry
+            if error is not None:
+                raise error
+            yield item, value
+    finally:
+        # Unblock the reader if the consumer stopped early
+        stop.set()
+        while reader.is_alive():
+            try:
+                buffer.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        reader.join()
+
+class BackgroundWriter:
+    """
+    Runs write calls in order in a background thread, holding at most `size` pending calls.
+
+    After a failed write the remaining calls are skipped, and the error is raised by the next
+    `submit` or by `close`.
+
+    Attributes:
+        pending (queue.Queue): The bounded queue of (function, args, kwargs) calls.
+        error (Exception): The first error raised by a write, or None.
+    """
+
+    def __init__(self, size=PREFETCH):
+        """
+        Starts the writer thread.
+        """
+        self.pending = queue.Queue(maxsize=size)
+        self.error = None
+        self.thread = threading.Thread(target=self._drain, daemon=True)
+        self.thread.start()
+
+    def _drain(self):
+        """
+        Executes the queued calls until the closing sentinel arrives.
+        """
+        while (task := self.pending.get()) is not None:
+            if self.error is None:
+                function, args, kwargs = task
+                try:
+                    function(*args, **kwargs)
+                except Exception as exc:
+                    self.error = exc
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Queues a write, blocking while `size` writes are already pending.
+        """
+        if self.error is not None:
+            raise self.error
+        self.pending.put((function, args, kwargs))
+
+    def close(self, raise_error=True):
+        """
+        Waits for the queued writes to finish and raises the first error of a failed write.
+
+        Parameters:
+            raise_error (bool): If False, only drain and join the writer thread.
+        """
+        self.pending.put(None)
+        self.thread.join()
+        if raise_error and self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        # Keep the error raised in the body as the cause; a failed write is only attached to it
+        self.close(raise_error=False)
+        if self.error is not None and self.error is not exc:
+            exc.add_note(f"The background writer also failed: {self.error!r}")
+
+def extract_pipelined(scenario, base_path, save_path_processed, prefetch=PREFETCH, output_format='netcdf',
+                      weighting='none', precision='float64'):
+    """
+    Extract all (variable, statistic) files of a scenario with the reads and writes overlapping the
+    regional means.
+
+    A reader thread loads the next subsets while the current one is reduced, and a writer thread
+    writes the spatial products. Both hand over through queues of `prefetch` subsets, which caps
+    the subsets held in memory at about 2 * prefetch + 3. Each file goes through the same steps as
+    in extract_variable, so the outputs are identical to the serial path. The netCDF4 backend of
+    xarray serializes the HDF5 calls of both threads with its own lock.
+
+    Parameters:
+    - scenario: str, the name of the scenario to process (e.g., 'historical', 'ssp119').
+    - base_path: str, the base directory containing the dataset.
+    - save_path_processed: str, the directory to save the processed spatial products.
+    - prefetch: int, the depth of the read and write queues.
+    - output_format: str, the backend used to write the spatial products, one of OUTPUT_FORMATS.
+    - weighting: str, the regional-mean reduction, one of WEIGHTINGS.
+    - precision: str, the working precision of the subsets, products and means, one of PRECISIONS.
+
+    Returns:
+    - dict mapping (data_var, stat) to the (time, regional mean) tuple returned by extract_variable.
+    """
+    tasks = [(file_var, data_var, stat) for file_var, data_var in zip(FILE_VARS, DATA_VARS) for stat in STATISTICS]
+
+    def load(task):
+        file_var, data_var, stat = task
+        with instrument.stage('open_select', 'extract_data', scenario=scenario, variable=data_var, stat=stat):
+            return load_and_select(input_path(base_path, scenario, file_var, stat), LON_RANGE, LAT_RANGE,
+                                   precision=precision)
+
+    def write(data, file_var, data_var, stat):
+        with instrument.stage('write_product', 'extract_data', scenario=scenario, variable=data_var, stat=stat):
+            write_product(data, save_path_processed, scenario, file_var, stat, output_format)
+
+    results = {}
+    with BackgroundWriter(prefetch) as writer:
+        for (file_var, data_var, stat), data in prefetched(load, tasks, prefetch):
+            area_mean = regional_mean(data, data_var, weighting)
+            writer.submit(write, data, file_var, data_var, stat)
+            results[(data_var, stat)] = (data["time"].to_numpy(), area_mean.to_numpy())
+    return results
+
+def combine_results(results):
+    """
+    Merge the regional-mean series of a scenario into a single table.
+
+    The column order does not depend on the order in which the results were produced,
+    so the serial and parallel paths write identical CSV files.
+
+    Parameters:
+    - results: dict, mapping (data_var, stat) to the (time, series) tuple returned by extract_variable.
+
+    Returns:
+    - pandas DataFrame with one column per variable and statistic, plus the time axis.
     """
-    file_vars = ['pHT', 'Aragonite', 'Calcite']
-    data_vars = ['pHT', 'aragonite', 'calcite']
     combined_data = {}
-    time_collected = False
-
-    for file_var, data_var in zip(file_vars, data_vars):
-        med_file = f'{base_path}/{scenario}/{file_var}_median_{scenario}.nc'
-        std_file = f'{base_path}/{scenario}/{file_var}_std_{scenario}.nc'
-        
-        med = load_and_select(med_file, (71, 172), (65, 119))
-        std = load_and_select(std_file, (71, 172), (65, 119))
-
-        # Save the NetCDF files after selection
-        med.to_netcdf(f"{save_path_processed}/{scenario}_{file_var.lower()}_med.nc")
-        std.to_netcdf(f"{save_path_processed}/{scenario}_{file_var.lower()}_std.nc")
-        
-        # Aggregate the data and store it in combined_data dictionary
-        combined_data[f"{data_var}_med"] = med[data_var].mean(dim=("lat", "lon")).to_numpy()
-        combined_data[f"{data_var}_std"] = std[data_var].mean(dim=("lat", "lon")).to_numpy()
-
-        if not time_collected:
-            combined_data['time'] = med["time"].to_numpy()
-            time_collected = True
-
-    # Save the aggregated data to a CSV file
-    df = pd.DataFrame(combined_data)
+    for data_var in DATA_VARS:
+        for stat in STATISTICS:
+            combined_data[f"{COLUMN_PREFIXES.get(data_var, data_var)}_{stat}"] = results[(data_var, stat)][1]
+        if 'time' not in combined_data:
+            combined_data['time'] = results[(data_var, 'med')][0]
+    return pd.DataFrame(combined_data)
+
+def save_temporal(df, save_path_temporal, scenario):
+    """
+    Save the regional-mean time series of a scenario as CSV and to the columnar temporal store.
+    """
     df.to_csv(f"{save_path_temporal}/{scenario}.csv", index=False)
+    temporal_store.write_scenario(df, save_path_temporal, scenario)
 
-def main():
+def process_and_save(scenario, base_path, save_path_processed, save_path_temporal, time_chunk=None,
+                     output_format='netcdf', weighting='none', prefetch=0, precision='float64'):
     """
-    Main function to process and save datasets for different climate scenarios.
+    Process and save the data for a given climate scenario by loading the data,
+    calculating the mean across specified dimensions, and saving the result to a CSV file.
+
+    Parameters:
+    - scenario: str, the name of the scenario to process (e.g., 'historical', 'ssp119').
+    - base_path: str, the base directory containing the dataset.
+    - save_path_processed: str, the directory to save the processed spatial products.
+    - save_path_temporal: str, the directory to save the summarized CSV files.
+    - time_chunk: int, optional, read the data lazily in chunks of this many time steps.
+    - output_format: str, the backend used to write the spatial products, one of OUTPUT_FORMATS.
+    - weighting: str, the regional-mean reduction, one of WEIGHTINGS.
+    - prefetch: int, read and write up to this many subsets in background threads while the
+      regional means are computed; 0 processes the files one after the other. Ignored with
+      time_chunk, which already streams each file.
+    - precision: str, the working precision of the subsets, products and CSV file, one of PRECISIONS.
+    """
+    results = {}
+    if prefetch and not time_chunk:
+        results = extract_pipelined(scenario, base_path, save_path_processed, prefetch=prefetch,
+                                    output_format=output_format, weighting=weighting, precision=precision)
+    else:
+        for file_var, data_var in zip(FILE_VARS, DATA_VARS):
+            for stat in STATISTICS:
+                results[(data_var, stat)] = extract_variable(scenario, file_var, data_var, stat,
+                                                             base_path, save_path_processed,
+                                                             time_chunk=time_chunk,
+                                                             output_format=output_format,
+                                                             weighting=weighting, precision=precision)
+    if output_format == 'zarr':
+        consolidate_store(save_path_processed, scenario)
+
+    # Save the aggregated data to a CSV file and the temporal store
+    df = combine_results(results)
+    with instrument.stage('save_temporal', 'extract_data', scenario=scenario):
+        save_temporal(df, save_path_temporal, scenario)
+
+def process_parallel(scenarios, base_path, save_path_processed, save_path_temporal, workers=None,
+                     time_chunk=None, output_format='netcdf', weighting='none', precision='float64'):
+    """
+    Process several scenarios on a process pool, fanning out over (scenario, variable, statistic) tasks.
+
+    A failing task does not abort the batch: the remaining tasks still run, and the CSV file of a
+    scenario is only written when all of its tasks succeeded.
+
+    Parameters:
+    - scenarios: list of str, the scenarios to process.
+    - base_path: str, the base directory containing the dataset.
+    - save_path_processed: str, the directory to save the processed spatial products.
+    - save_path_temporal: str, the directory to save the summarized CSV files.
+    - workers: int, the number of worker processes (default: number of CPUs).
+    - time_chunk: int, optional, read the data lazily in chunks of this many time steps.
+    - output_format: str, the backend used to write the spatial products, one of OUTPUT_FORMATS.
+    - weighting: str, the regional-mean reduction, one of WEIGHTINGS.
+    - precision: str, the working precision of the subsets, products and CSV files, one of PRECISIONS.
+
+    Returns:
+    - dict mapping (scenario, file_var, stat) to the exception raised by each failed task.
+    """
+    results = {scenario: {} for scenario in scenarios}
+    failures = {}
+
+    # Spawn the workers: forking a process that already holds HDF5/netCDF handles can deadlock
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = {}
+        for scenario in scenarios:
+            for file_var, data_var in zip(FILE_VARS, DATA_VARS):
+                for stat in STATISTICS:
+                    future = executor.submit(extract_variable, scenario, file_var, data_var, stat,
+                                             base_path, save_path_processed, time_chunk=time_chunk,
+                                             output_format=output_format, weighting=weighting,
+                                             precision=precision)
+                    futures[future] = (scenario, file_var, data_var, stat)
+
+        for future in as_completed(futures):
+            scenario, file_var, data_var, stat = futures[future]
+            try:
+                results[scenario][(data_var, stat)] = future.result()
+            except Exception as exc:
+                failures[(scenario, file_var, stat)] = exc
+                print(f"Failed to process {file_var} {stat} for {scenario}: {exc!r}")
+
+    # Merge in scenario order so the output does not depend on task completion order
+    for scenario in scenarios:
+        if any(key[0] == scenario for key in failures):
+            print(f"Skipping {scenario}.csv: not all variables were processed")
+            continue
+        if output_format == 'zarr':
+            consolidate_store(save_path_processed, scenario)
+        df = combine_results(results[scenario])
+        with instrument.stage('save_temporal', 'extract_data', scenario=scenario):
+            save_temporal(df, save_path_temporal, scenario)
+
+    return failures
+
+def scenario_files(scenario, base_path, save_path_processed, save_path_temporal, output_format='netcdf'):
+    """
+    List the input files read and the outputs written when processing a scenario.
+
+    Parameters:
+    - scenario: str, the name of the scenario (e.g., 'historical', 'ssp119').
+    - base_path: str, the base directory containing the dataset.
+    - save_path_processed: str, the directory to save the processed spatial products.
+    - save_path_temporal: str, the directory to save the summarized CSV files.
+    - output_format: str, the backend used to write the spatial products, one of OUTPUT_FORMATS.
+
+    Returns:
+    - tuple (inputs, outputs) of lists of paths.
+    """
+    inputs, outputs = [], []
+    for file_var in FILE_VARS:
+        for stat in STATISTICS:
+            inputs.append(input_path(base_path, scenario, file_var, stat))
+            path, _ = product_path(save_path_processed, scenario, file_var, stat, output_format)
+            if path not in outputs:
+                outputs.append(path)
+    outputs.append(f"{save_path_temporal}/{scenario}.csv")
+    outputs.append(f"{save_path_temporal}/store/{scenario}.npy")
+    return inputs, outputs
+
+def processing_params(output_format='netcdf', weighting='none', precision='float64'):
+    """
+    Collect the parameters that determine the content of the outputs, for the manifest.
+    """
+    return {'lon_range': list(LON_RANGE), 'lat_range': list(LAT_RANGE), 'output_format': output_format,
+            'weighting': weighting, 'precision': precision}
+
+def stale_scenarios(scenarios, records, base_path, save_path_processed, save_path_temporal,
+                    output_format='netcdf', weighting='none', method='hash', precision='float64'):
+    """
+    Select the scenarios whose manifest records no longer match their inputs, outputs or parameters.
+
+    Parameters:
+    - scenarios: list of str, the scenarios to check.
+    - records: dict, the manifest loaded with manifest.load_manifest.
+    - base_path: str, the base directory containing the dataset.
+    - save_path_processed: str, the directory to save the processed spatial products.
+    - save_path_temporal: str, the directory to save the summarized CSV files.
+    - output_format: str, the backend used to write the spatial products, one of OUTPUT_FORMATS.
+    - weighting: str, the regional-mean reduction, one of WEIGHTINGS.
+    - method: str, the fingerprint method, one of manifest.FINGERPRINT_METHODS.
+    - precision: str, the working precision, one of PRECISIONS.
+
+    Returns:
+    - list of str, the scenarios that have to be (re)processed.
+    """
+    params = processing_params(output_format, weighting, precision)
+    stale = []
+    for scenario in scenarios:
+        inputs, outputs = scenario_files(scenario, base_path, save_path_processed, save_path_temporal,
+                                         output_format)
+        if not manifest.is_up_to_date(records.get(scenario), inputs, outputs, params, method):
+            stale.append(scenario)
+    return stale
+
+def record_scenario(records, scenario, base_path, save_path_processed, save_path_temporal,
+                    output_format='netcdf', weighting='none', method='hash', precision='float64'):
+    """
+    Record the inputs, outputs and parameters of a successfully processed scenario in the manifest.
+    """
+    inputs, outputs = scenario_files(scenario, base_path, save_path_processed, save_path_temporal,
+                                     output_format)
+    records[scenario] = manifest.make_record(inputs, outputs,
+                                            processing_params(output_format, weighting, precision), method)
+
+def run(data_root='../data', scenarios=SCENARIOS, workers=1, time_chunk=None, output_format='netcdf',
+        weighting='none', fingerprint='hash', force=False, prefetch=0, precision='float64'):
+    """
+    Process the scenarios whose outputs are missing or out of date and record them in the manifest.
+
+    Parameters:
+    - data_root: str, the data directory holding pre_processed/acid and receiving the processed products.
+    - scenarios: list of str, the scenarios to consider.
+    - workers: int, the number of worker processes; 1 processes the scenarios serially.
+    - time_chunk: int, optional, read the inputs lazily in chunks of this many time steps.
+    - output_format: str, the backend used to write the spatial products, one of OUTPUT_FORMATS.
+    - weighting: str, the regional-mean reduction, one of WEIGHTINGS.
+    - fingerprint: str, the fingerprint method, one of manifest.FINGERPRINT_METHODS.
+    - force: bool, reprocess all scenarios, even if the manifest says they are up to date.
+    - prefetch: int, overlap the reads and writes of a serial run with this many subsets in flight;
+      0 disables the background threads.
+    - precision: str, the working precision of the subsets, products and CSV files, one of PRECISIONS.
+
+    Returns:
+    - dict mapping (scenario, file_var, stat) to the exception raised by each failed task.
     """
     # Define the base path for the input data and the paths for saving processed data
-    base_path = '../data/pre_processed/acid'
-    save_path_processed = '../data/processed/spa'
-    save_path_temporal = '../data/processed/temporal'
+    base_path = f'{data_root}/pre_processed/acid'
+    save_path_processed = f'{data_root}/processed/spa'
+    save_path_temporal = f'{data_root}/processed/temporal'
+    manifest_path = f'{data_root}/processed/manifest.json'
+    os.makedirs(save_path_processed, exist_ok=True)
+    os.makedirs(save_path_temporal, exist_ok=True)
 
-    # List of scenarios to process
-    scenarios = ['historical', 'ssp119', 'ssp126', 'ssp245', 'ssp370', 'ssp585']
-    
+    records = manifest.load_manifest(manifest_path)
+    files = (base_path, save_path_processed, save_path_temporal, output_format, weighting, fingerprint, precision)
+    if force:
+        stale = list(scenarios)
+    else:
+        stale = stale_scenarios(scenarios, records, *files)
     for scenario in scenarios:
-        process_and_save(scenario, base_path, save_path_processed, save_path_temporal)
+        if scenario not in stale:
+            print(f"{scenario} is up to date, skipping")
+
+    # Forget the scenarios about to be rebuilt, so an interrupted run cannot leave them marked as current
+    for scenario in stale:
+        records.pop(scenario, None)
+    manifest.save_manifest(records, manifest_path)
+
+    if workers > 1:
+        failures = process_parallel(stale, base_path, save_path_processed, save_path_temporal,
+                                    workers=workers, time_chunk=time_chunk, output_format=output_format,
+                                    weighting=weighting, precision=precision)
+        failed = {key[0] for key in failures}
+        for scenario in stale:
+            if scenario not in failed:
+                record_scenario(records, scenario, *files)
+        manifest.save_manifest(records, manifest_path)
+        return failures
+
+    for scenario in stale:
+        with instrument.stage('process_scenario', 'extract_data', scenario=scenario):
+            process_and_save(scenario, base_path, save_path_processed, save_path_temporal,
+                             time_chunk=time_chunk, output_format=output_format, weighting=weighting,
+                             prefetch=prefetch, precision=precision)
+        record_scenario(records, scenario, *files)
+        manifest.save_manifest(records, manifest_path)
+    return {}
+
+def precision_deviation(scenario, base_path, precision='float32', weighting='none'):
+    """
+    Measure how far a working precision moves the subsets and regional means of a scenario from the
+    float64 path.
+
+    Parameters:
+    - scenario: str, the name of the scenario to check (e.g., 'historical', 'ssp119').
+    - base_path: str, the base directory containing the dataset.
+    - precision: str, the working precision to check, one of PRECISIONS.
+    - weighting: str, the regional-mean reduction, one of WEIGHTINGS.
+
+    Returns:
+    - pandas DataFrame with one row per variable and statistic: the largest absolute deviation of the
+      subset values and of the regional mean, and the latter relative to the largest regional mean.
+    """
+    rows = []
+    for file_var, data_var in zip(FILE_VARS, DATA_VARS):
+        for stat in STATISTICS:
+            in_file = input_path(base_path, scenario, file_var, stat)
+            reference = load_and_select(in_file, LON_RANGE, LAT_RANGE)
+            working = load_and_select(in_file, LON_RANGE, LAT_RANGE, precision=precision)
+            reference_mean = regional_mean(reference, data_var, weighting).to_numpy()
+            working_mean = regional_mean(working, data_var, weighting).to_numpy().astype(np.float64)
+            subset_deviation = np.abs(working[data_var].to_numpy().astype(np.float64)
+                                      - reference[data_var].to_numpy())
+            mean_deviation = np.nanmax(np.abs(working_mean - reference_mean))
+            rows.append({'scenario': scenario, 'column': f"{COLUMN_PREFIXES.get(data_var, data_var)}_{stat}",
+                         'subset': np.nanmax(subset_deviation), 'regional_mean': mean_deviation,
+                         'relative': mean_deviation / np.nanmax(np.abs(reference_mean))})
+    return pd.DataFrame(rows)
+
+def check_precision(data_root='../data', scenarios=SCENARIOS, precision='float32', weighting='none'):
+    """
+    Report the largest deviation of a working precision from the float64 path for each scenario.
+
+    Returns:
+    - pandas DataFrame, the rows of precision_deviation for all scenarios.
+    """
+    base_path = f'{data_root}/pre_processed/acid'
+    report = pd.concat([precision_deviation(scenario, base_path, precision, weighting) for scenario in scenarios],
+                       ignore_index=True)
+    print(f"Largest deviation of {precision} from float64:")
+    print(report.to_string(index=False, float_format='{:.3e}'.format))
+    return report
+
+def main():
+    """
+    Main function to process and save datasets for different climate scenarios.
+    """
+    parser = argparse.ArgumentParser(description="Extract Coral Triangle time series and spatial data.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes; 1 processes the scenarios serially")
+    parser.add_argument("--time-chunk", type=int, default=None,
+                        help="read the inputs lazily in chunks of this many time steps")
+    parser.add_argument("--prefetch", type=int, default=0,
+                        help="with one worker, read and write up to this many subsets in background threads")
+    parser.add_argument("--format", dest="output_format", choices=OUTPUT_FORMATS, default='netcdf',
+                        help="output backend for the spatial products")
+    parser.add_argument("--weighting", choices=WEIGHTINGS, default='none',
+                        help="regional-mean reduction: plain lat/lon mean or area-weighted ocean mean")
+    parser.add_argument("--precision", choices=PRECISIONS, default='float64',
+                        help="working precision of the subsets, spatial products and CSV files")
+    parser.add_argument("--check-precision", action="store_true",
+                        help="report the largest deviation of --precision from float64 instead of processing")
+    parser.add_argument("--fingerprint", choices=manifest.FINGERPRINT_METHODS, default='hash',
+                        help="detect changed files by content hash or by size and mtime")
+    parser.add_argument("--force", action="store_true",
+                        help="reprocess all scenarios, even if the manifest says they are up to date")
+    parser.add_argument("--trace", metavar="JSON", default=None,
+                        help="record the time and memory of each stage to a Chrome-trace file")
+    args = parser.parse_args()
+    if args.trace:
+        instrument.enable(args.trace)
+    if args.check_precision:
+        check_precision(precision=args.precision, weighting=args.weighting)
+        return
+
+    failures = run(workers=args.workers, time_chunk=args.time_chunk, output_format=args.output_format,
+                   weighting=args.weighting, fingerprint=args.fingerprint, force=args.force,
+                   prefetch=args.prefetch, precision=args.precision)
+    if failures:
+        raise SystemExit(f"{len(failures)} task(s) failed")
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+"""
+figure_cache.py
+Figure registry with a content-addressed cache of the rendered figures
+
+Author: Sandy Herho
+Email: sandy.herho@email.ucr.edu
+Date: 05/30/2024
+"""
+
+import fcntl
+import functools
+import hashlib
+import inspect
+
+import manifest
+
+# Plot style shared by the figures of all scripts
+STYLE = 'bmh'
+
+def pyplot(style=STYLE):
+    """
+    Import pyplot on first use and apply the plot style.
+
+    The scripts call this when they draw, instead of importing matplotlib and setting the style at
+    module level, so importing them stays fast and leaves the global matplotlib state untouched.
+
+    Returns:
+    - module matplotlib.pyplot.
+    """
+    import matplotlib.pyplot as plt
+
+    plt.style.use(style)
+    return plt
+
+def code_fingerprint(code):
+    """
+    Hash the source of the function or class that draws a figure, so editing it invalidates the figure.
+
+    Parameters:
+    - code: function, class or functools.partial, or None.
+
+    Returns:
+    - str SHA-256 of the source, or None if there is no source to hash.
+    """
+    while isinstance(code, functools.partial):
+        code = code.func
+    if code is None:
+        return None
+    try:
+        source = inspect.getsource(code)
+    except (OSError, TypeError):
+        return None
+    return hashlib.sha256(source.encode()).hexdigest()
+
+class FigureRegistry:
+    """
+    Declarative list of figures with the inputs, variables and plot parameters each one depends on.
+
+    A figure is rebuilt only if its manifest record no longer matches the fingerprints of its input
+    files and output PNGs, its parameters, or the source of the code drawing it.
+
+    Attributes:
+        manifest_path (str): JSON file holding the records of the rendered figures.
+        method (str): The fingerprint method, one of manifest.FINGERPRINT_METHODS.
+        figures (dict): The registered figures, keyed by name.
+    """
+
+    def __init__(self, manifest_path='../figs/figures.json', method='hash'):
+        """
+        Initializes an empty registry backed by a manifest file.
+        """
+        self.manifest_path = manifest_path
+        self.method = method
+        self.figures = {}
+        self.records = manifest.load_manifest(manifest_path)
+
+    def register(self, name, outputs, inputs=(), params=None, render=None, code=None):
+        """
+        Declares a figure.
+
+        Parameters:
+            name (str): A unique name of the figure.
+            outputs (list): The files written when the figure is rendered.
+            inputs (list): The data files the figure is drawn from.
+            params (dict): JSON-serializable variables and plot parameters of the figure.
+            render (callable): Draws and saves the figure when called without arguments. Figures
+                without it are rendered by the caller, e.g. in a batch, and recorded with `record`.
+            code (callable): The function or class whose source is part of the cache key;
+                defaults to `render`.
+        """
+        params = dict(params or {}, code=code_fingerprint(code if code is not None else render))
+        self.figures[name] = {'outputs': list(outputs), 'inputs': list(inputs), 'params': params,
+                              'render': render}
+
+    def is_up_to_date(self, name):
+        """
+        Checks whether a figure can be reused without rendering it again.
+        """
+        figure = self.figures[name]
+        return manifest.is_up_to_date(self.records.get(name), figure['inputs'], figure['outputs'],
+                                      figure['params'], self.method)
+
+    def stale(self, force=False):
+        """
+        Returns the names of the figures that have to be rendered, in registration order.
+        """
+        return [name for name in self.figures if force or not self.is_up_to_date(name)]
+
+    def dry_run(self, force=False):
+        """
+        Prints which figures would be rebuilt and which are up to date, without rendering anything.
+
+        Returns:
+            list: The names of the figures that would be rebuilt.
+        """
+        stale = self.stale(force)
+        for name in self.figures:
+            print(f"{'rebuild' if name in stale else 'up to date':>10}  {name}")
+        print(f"{len(stale)} of {len(self.figures)} figure(s) would be rebuilt")
+        return stale
+
+    def record(self, names):
+        """
+        Records rendered figures in the manifest.
+
+        Other figures in the manifest file, e.g. those of another script, are kept. The manifest is
+        locked while it is updated, so scripts running at the same time do not drop each other's records.
+        """
+        for name in names:
+            figure = self.figures[name]
+            self.records[name] = manifest.make_record(figure['inputs'], figure['outputs'], figure['params'],
+                                                      self.method)
+        with open(f"{self.manifest_path}.lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            records = manifest.load_manifest(self.manifest_path)
+            records.update({name: self.records[name] for name in names})
+            manifest.save_manifest(records, self.manifest_path)
+
+    def build(self, force=False):
+        """
+        Renders the stale figures that have a render function and records each one after it is saved.
+
+        Returns:
+            list: The names of the rendered figures.
+        """
+        rendered = []
+        for name in self.stale(force):
+            render = self.figures[name]['render']
+            if render is None:
+                continue
+            render()
+            self.record([name])
+            rendered.append(name)
+        return rendered
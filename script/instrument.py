@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+
+"""
+instrument.py
+Opt-in stage timing and memory instrumentation with Chrome-trace output
+
+Author: Sandy Herho
+Email: sandy.herho@email.ucr.edu
+Date: 06/17/2024
+"""
+
+import argparse
+import atexit
+import glob
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Environment variable holding the trace file; inherited by spawned worker processes
+TRACE_VARIABLE = 'CT_TRACE'
+
+# Process that merges the events of all processes into the trace file when it exits
+OWNER_VARIABLE = 'CT_TRACE_OWNER'
+
+_lock = threading.Lock()
+_trace_path = None
+
+# Peak RSS of the stages still running, keyed by stage, and of the process before the last reset of the
+# kernel's high-water mark, in megabytes
+_open_peaks = {}
+_lifetime_peak = 0.0
+
+def peak_rss_mb():
+    """
+    Return the peak resident set size of this process in megabytes.
+
+    The peak is the high-water mark of the whole process lifetime, not of the current stage. Stages reset
+    the kernel's high-water mark, which also lowers ru_maxrss, so the marks seen before each reset are
+    folded back in.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    peak = peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+    return max(peak, _lifetime_peak)
+
+def high_water_mb():
+    """
+    Return the high-water mark of the resident set size since it was last reset, in megabytes, or None
+    where /proc/self/status is not available.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, IndexError, ValueError):
+        pass
+    return None
+
+def reset_high_water():
+    """
+    Reset the high-water mark of the resident set size to the current RSS through /proc/self/clear_refs.
+
+    Returns:
+    - bool, whether the mark was reset; False where clear_refs is not available or not writable.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+    return True
+
+def _fold_high_water():
+    """
+    Raise the peaks of the running stages and of the process to the current high-water mark.
+    The caller holds _lock.
+    """
+    global _lifetime_peak
+    mark = high_water_mb()
+    if mark is None:
+        return
+    _lifetime_peak = max(_lifetime_peak, mark)
+    for key, peak in _open_peaks.items():
+        _open_peaks[key] = max(peak, mark)
+
+def rss_mb():
+    """
+    Return the current resident set size of this process in megabytes, or None where /proc/self/statm
+    is not available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            resident = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return resident * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+
+def io_counters():
+    """
+    Return the bytes read and written by this process so far, including reads served from the page cache.
+
+    Returns:
+    - tuple (read, written) of ints, or (None, None) where /proc/self/io is not available.
+    """
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines() if ': ' in line)
+        return int(fields['rchar']), int(fields['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+def enable(path):
+    """
+    Record the stages of this process and of the worker processes it spawns, and write them to a
+    Chrome-trace JSON file (chrome://tracing, Perfetto) when the process exits.
+
+    Setting the CT_TRACE environment variable to a file name has the same effect.
+
+    Parameters:
+    - path: str, the trace file.
+    """
+    global _trace_path
+    _trace_path = os.path.abspath(path)
+    os.environ[TRACE_VARIABLE] = _trace_path
+    if os.environ.get(OWNER_VARIABLE) is None:
+        os.environ[OWNER_VARIABLE] = str(os.getpid())
+        for part in glob.glob(f"{glob.escape(_trace_path)}.*.part"):
+            os.remove(part)
+        atexit.register(save_trace)
+        process_name(os.path.basename(sys.argv[0]) or 'python')
+    elif os.environ[OWNER_VARIABLE] != str(os.getpid()):
+        process_name('worker')
+
+def enabled():
+    """
+    Check whether stages are recorded in this process.
+    """
+    return _trace_path is not None
+
+def _emit(event):
+    """
+    Append an event to the part file of this process; the owner merges the part files on exit.
+    """
+    with _lock:
+        with open(f"{_trace_path}.{os.getpid()}.part", 'a') as f:
+            f.write(json.dumps(event, default=str) + '\n')
+
+def process_name(name):
+    """
+    Label this process in the trace viewer.
+    """
+    if enabled():
+        _emit({'name': 'process_name', 'ph': 'M', 'pid': os.getpid(), 'args': {'name': name}})
+
+@contextmanager
+def stage(name, category='pipeline', **args):
+    """
+    Record the wall time, CPU time, memory and bytes read and written of a block as one trace event.
+
+    The memory of the stage is its peak resident set size, peak_rss_mb, next to the RSS at its end and
+    the change of the RSS between its start and end, rss_delta_mb. The peak is measured by resetting the
+    kernel's high-water mark when the stage starts, and is shared with the stages running at the same time
+    in other threads; it is None where /proc/self/clear_refs is not available.
+
+    Does nothing unless tracing was enabled, so stages can stay in the code at no cost.
+
+    Parameters:
+    - name: str, the name of the stage, e.g. 'write_product'.
+    - category: str, the group of the stage, usually the script it belongs to.
+    - args: JSON-serializable labels of the event, e.g. scenario='ssp585'.
+    """
+    if _trace_path is None:
+        yield
+        return
+    start_ts = time.time_ns() // 1000
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    start_read, start_written = io_counters()
+    start_rss = rss_mb()
+    key = object()
+    with _lock:
+        # The marks reached so far belong to the stages already running, before the reset
+        _fold_high_water()
+        if reset_high_water():
+            _open_peaks[key] = high_water_mb() or 0.0
+    try:
+        yield
+    finally:
+        with _lock:
+            _fold_high_water()
+            peak = _open_peaks.pop(key, None)
+        wall, cpu = time.perf_counter() - start_wall, time.process_time() - start_cpu
+        read, written = io_counters()
+        if read is not None and start_read is not None:
+            read, written = read - start_read, written - start_written
+        end_rss = rss_mb()
+        rss_delta = end_rss - start_rss if end_rss is not None and start_rss is not None else None
+        _emit({'name': name, 'cat': category, 'ph': 'X', 'ts': start_ts, 'dur': round(wall * 1e6),
+               'pid': os.getpid(), 'tid': threading.get_native_id(),
+               'args': dict(args, wall_s=wall, cpu_s=cpu, rss_mb=end_rss, rss_delta_mb=rss_delta,
+                            peak_rss_mb=peak, bytes_read=read, bytes_written=written)})
+
+def load_events(path):
+    """
+    Read the events of all processes recorded for a trace file, in time order.
+    """
+    events = []
+    for part in glob.glob(f"{glob.escape(path)}.*.part"):
+        with open(part) as f:
+            events.extend(json.loads(line) for line in f if line.strip())
+    return sorted(events, key=lambda event: event.get('ts', 0))
+
+def save_trace():
+    """
+    Merge the events of this process and its workers into the trace file and remove the part files.
+    """
+    if _trace_path is None:
+        return
+    events = load_events(_trace_path)
+    with open(_trace_path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    for part in glob.glob(f"{glob.escape(_trace_path)}.*.part"):
+        os.remove(part)
+
+def summarize(path):
+    """
+    Total the recorded stages of a trace file by name and category.
+
+    Returns:
+    - list of dicts with the number of calls, wall and CPU seconds, bytes read and written, the largest
+      RSS growth and the largest peak RSS of a single call of each stage, slowest first.
+    """
+    with open(path) as f:
+        events = [event for event in json.load(f)['traceEvents'] if event['ph'] == 'X']
+    totals = {}
+    for event in events:
+        total = totals.setdefault((event['cat'], event['name']), {
+            'category': event['cat'], 'stage': event['name'], 'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0,
+            'bytes_read': 0, 'bytes_written': 0, 'rss_delta_mb': 0.0, 'peak_rss_mb': 0.0})
+        total['calls'] += 1
+        for key in ('wall_s', 'cpu_s', 'bytes_read', 'bytes_written'):
+            total[key] += event['args'][key] or 0
+        total['rss_delta_mb'] = max(total['rss_delta_mb'], event['args'].get('rss_delta_mb') or 0.0)
+        total['peak_rss_mb'] = max(total['peak_rss_mb'], event['args'].get('peak_rss_mb') or 0.0)
+    return sorted(totals.values(), key=lambda total: -total['wall_s'])
+
+# Opt in from the environment, e.g. CT_TRACE=../trace.json python extract_data.py
+if os.environ.get(TRACE_VARIABLE):
+    enable(os.environ[TRACE_VARIABLE])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize the stages recorded in a trace file.")
+    parser.add_argument("trace", help="trace file written with CT_TRACE or --trace")
+    args = parser.parse_args()
+    for total in summarize(args.trace):
+        print(f"{total['category']:>15} {total['stage']:>20}: {total['calls']:4d} call(s) "
+              f"{total['wall_s']:9.3f} s wall {total['cpu_s']:9.3f} s cpu "
+              f"{total['bytes_read'] / 1024 ** 2:9.1f} MB read {total['bytes_written'] / 1024 ** 2:9.1f} MB written "
+              f"RSS +{total['rss_delta_mb']:.0f} MB (peak {total['peak_rss_mb']:.0f} MB)")
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+"""
+manifest.py
+Input/output manifest for incremental processing
+
+Author: Sandy Herho
+Email: sandy.herho@email.ucr.edu
+Date: 05/02/2024
+"""
+
+import hashlib
+import json
+import os
+
+FINGERPRINT_METHODS = ['hash', 'stat']
+
+def file_fingerprint(path, method='hash', block_size=1 << 20):
+    """
+    Fingerprint a file, or a directory such as a Zarr store, by content hash or by size and mtime.
+
+    Parameters:
+    - path: str, the file or directory to fingerprint.
+    - method: str, 'hash' for a SHA-256 of the content, 'stat' for size and modification time.
+    - block_size: int, number of bytes read at a time when hashing.
+
+    Returns:
+    - str fingerprint, or None if the path does not exist.
+    """
+    if not os.path.exists(path):
+        return None
+    if os.path.isdir(path):
+        files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+    else:
+        files = [path]
+
+    digest = hashlib.sha256()
+    for file in files:
+        digest.update(os.path.relpath(file, path).encode())
+        if method == 'stat':
+            info = os.stat(file)
+            digest.update(f"{info.st_size}:{info.st_mtime_ns}".encode())
+        else:
+            with open(file, 'rb') as f:
+                for block in iter(lambda: f.read(block_size), b''):
+                    digest.update(block)
+    return f"{method}:{digest.hexdigest()}"
+
+def load_manifest(path):
+    """
+    Load a manifest from a JSON file.
+
+    Parameters:
+    - path: str, the manifest file.
+
+    Returns:
+    - dict mapping entry names to records; empty if the file does not exist or cannot be parsed.
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_manifest(manifest, path):
+    """
+    Save a manifest to a JSON file. The file is replaced atomically, so an interrupted run never
+    leaves a truncated manifest behind.
+
+    Parameters:
+    - manifest: dict, mapping entry names to records.
+    - path: str, the manifest file.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def make_record(inputs, outputs, params, method='hash'):
+    """
+    Build a manifest record for a set of inputs, outputs and processing parameters.
+
+    Parameters:
+    - inputs: list of str, the input files.
+    - outputs: list of str, the output files or directories.
+    - params: dict, JSON-serializable processing parameters.
+    - method: str, the fingerprint method, one of FINGERPRINT_METHODS.
+
+    Returns:
+    - dict record.
+    """
+    return {
+        'inputs': {path: file_fingerprint(path, method) for path in inputs},
+        'outputs': {path: file_fingerprint(path, method) for path in outputs},
+        'params': json.loads(json.dumps(params)),
+    }
+
+def is_up_to_date(record, inputs, outputs, params, method='hash'):
+    """
+    Check whether a manifest record still describes the current inputs, outputs and parameters.
+
+    A missing record, a changed or missing input, a changed parameter, and a missing, partial or
+    modified output all make the record stale.
+
+    Parameters:
+    - record: dict, the stored record, or None.
+    - inputs: list of str, the input files.
+    - outputs: list of str, the output files or directories.
+    - params: dict, JSON-serializable processing parameters.
+    - method: str, the fingerprint method, one of FINGERPRINT_METHODS.
+
+    Returns:
+    - bool, True if nothing needs to be rebuilt.
+    """
+    if not record:
+        return False
+    current = make_record(inputs, outputs, params, method)
+    if None in current['inputs'].values() or None in current['outputs'].values():
+        return False
+    return current == record
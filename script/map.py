@@ -9,8 +9,13 @@ Email: sandy.herho@email.ucr.edu
 Date: 03/29/2024
 """
 
+import argparse
+
 import pygmt
 
+from instrument import peak_rss_mb
+from relief_cache import DECIMATION_METHODS, ReliefCache, decimation_factor, required_resolution
+
 
 class SRTMMapPlotter:
     """
@@ -18,7 +23,14 @@ class SRTMMapPlotter:
 
     Attributes:
         region (list): The geographical region to plot specified as [west, east, south, north].
-        resolution (str): The resolution of the Earth relief data. Default is "15s".
+        resolution (str): The resolution of the Earth relief data, e.g. "15s". "auto" picks the coarsest
+            level of the relief cache that still resolves every pixel of the saved figure.
+        width (float): The width of the map in centimeters.
+        dpi (int): The resolution of the saved figure in dots per inch.
+        cache (ReliefCache): The local tile cache the relief is read from.
+        decimation (int): Block size by which the relief is reduced while it is read; "auto" reduces
+            it to about one grid cell per output pixel.
+        method (str): The block reduction, "mean" or "median".
         grid (xarray.DataArray): The loaded Earth relief data for the specified region.
         figure (pygmt.Figure): The PyGMT figure object for plotting.
 
@@ -31,35 +43,49 @@ class SRTMMapPlotter:
         save(filename, dpi): Saves the figure to a file with the specified resolution.
     """
 
-    def __init__(self, region, resolution="15s"):
+    def __init__(self, region, resolution="auto", width=15, dpi=400, cache=None, decimation=1, method="mean"):
         """
         Initializes the SRTMMapPlotter object with a specified region and resolution.
 
         Parameters:
             region (list): The geographical region to plot specified as [west, east, south, north].
-            resolution (str): The resolution of the Earth relief data. Default is "15s".
+            resolution (str): The resolution of the Earth relief data. Default is "auto".
+            width (float): The width of the map in centimeters. Default is 15.
+            dpi (int): The resolution of the saved figure in dots per inch. Default is 400.
+            cache (ReliefCache): The relief tile cache. Default is a cache in ../data/relief.
+            decimation (int): Block size by which the relief is reduced while it is read. Default is 1.
+            method (str): The block reduction, "mean" or "median". Default is "mean".
         """
         self.region = region
+        self.width = width
+        self.dpi = dpi
+        self.cache = cache if cache is not None else ReliefCache()
+        if resolution == "auto":
+            resolution = required_resolution(region, width, dpi, self.cache.levels())
         self.resolution = resolution
+        if decimation == "auto":
+            decimation = decimation_factor(region, width, dpi, resolution)
+        self.decimation = decimation
+        self.method = method
         self.grid = self.load_data()
         self.figure = pygmt.Figure()
 
     def load_data(self):
         """
-        Loads the Earth relief data for the specified region and resolution.
+        Loads the Earth relief data for the specified region and resolution from the tile cache.
+        With decimation, the tiles are streamed from disk and only the reduced grid is kept, so it is
+        also the only grid handed to PyGMT.
 
         Returns:
             xarray.DataArray: The loaded Earth relief data.
         """
-        return pygmt.datasets.load_earth_relief(
-            resolution=self.resolution, region=self.region
-        )
+        return self.cache.load(self.region, self.resolution, factor=self.decimation, method=self.method)
 
     def plot_map(self):
         """
         Plots the Earth relief data as a map using the loaded grid data.
         """
-        self.figure.grdimage(grid=self.grid, projection="M15c", frame="a", cmap="geo")
+        self.figure.grdimage(grid=self.grid, projection=f"M{self.width}c", frame="a", cmap="geo")
 
     def plot_marker(self, x, y, style="c0.3c", fill="red"):
         """
@@ -88,26 +114,49 @@ class SRTMMapPlotter:
         """
         self.figure.show()
 
-    def save(self, filename="../figs/fig1.png", dpi=400):
+    def save(self, filename="../figs/fig1.png", dpi=None):
         """
         Saves the figure to a file with the specified resolution.
 
         Parameters:
             filename (str): The path and name of the file to save the figure.
-            dpi (int): The resolution in dots per inch (DPI) for the saved figure. Default is 400.
+            dpi (int): The resolution in dots per inch (DPI) for the saved figure. Default is the DPI
+                the relief resolution was chosen for.
         """
-        self.figure.savefig(filename, dpi=dpi)
+        self.figure.savefig(filename, dpi=dpi or self.dpi)
 
 
 # CT map
-if __name__ == "__main__":
+def main(figs_dir="../figs", cache_dir="../data/relief", source=None, resolution="auto", decimation=1,
+         method="mean", show=True):
+    """
+    Plots and saves the map of the study area.
+    """
     # Initialize the plotter with a specific geographical region
-    plotter = SRTMMapPlotter(region=[95, 191, -25, 30])
+    plotter = SRTMMapPlotter(region=[95, 191, -25, 30], resolution=resolution,
+                             cache=ReliefCache(cache_dir, source=source), decimation=decimation, method=method)
     # Plot the Earth relief map
     plotter.plot_map()
     # Add a colorbar to the map
     plotter.add_colorbar()
     # Display the map
-    plotter.show()
+    if show:
+        plotter.show()
     # Save the map to a file
-    plotter.save()
+    plotter.save(f"{figs_dir}/fig1.png")
+    print(f"Relief grid {plotter.grid.shape} at {plotter.resolution} / {plotter.decimation}, "
+          f"peak RSS {peak_rss_mb():.0f} MB")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plot the map of the study area.")
+    parser.add_argument("--source", default=None,
+                        help="local relief grid (NetCDF) to build the tile cache from, for offline use")
+    parser.add_argument("--resolution", default="auto",
+                        help="relief resolution, e.g. 15s or 02m; auto matches the figure width and DPI")
+    parser.add_argument("--decimation", default="1",
+                        help="block size by which the relief is reduced before plotting, or auto")
+    parser.add_argument("--method", choices=DECIMATION_METHODS, default="mean",
+                        help="block reduction used for the decimation")
+    args = parser.parse_args()
+    main(source=args.source, resolution=args.resolution,
+         decimation=args.decimation if args.decimation == "auto" else int(args.decimation), method=args.method)
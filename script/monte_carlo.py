@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+
+"""
+monte_carlo.py
+Monte Carlo uncertainty bands of the regional-mean time series
+
+Author: Sandy Herho
+Email: sandy.herho@email.ucr.edu
+Date: 05/24/2024
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from extract_data import (COLUMN_PREFIXES, DATA_VARS, FILE_VARS, OUTPUT_FORMATS, SCENARIOS, WEIGHTINGS,
+                          product_path)
+
+# Quantiles of the regional mean reported for each time step
+QUANTILES = (0.025, 0.5, 0.975)
+
+# Products written under other names by earlier versions of extract_data:
+# (scenario, file_var, stat) -> file name in data/processed/spa
+LEGACY_PRODUCTS = {('ssp119', 'pHT', 'std'): 'ssp119_std_med.nc'}
+
+# Cell-to-cell correlation of the sampled errors:
+# - independent: every cell is perturbed independently
+# - full: all cells of a time step share one standard-normal draw
+CORRELATIONS = ['independent', 'full']
+
+def band_columns(column, quantiles=QUANTILES):
+    """
+    Build the names of the quantile columns of a variable, e.g. pH_q2.5, pH_q50 and pH_q97.5.
+    """
+    return [f"{column}_q{100 * q:g}" for q in quantiles]
+
+def sample_regional_means(med, std, weights, n_samples=1000, batch_size=100, seed=0,
+                          correlation='independent'):
+    """
+    Draw Monte Carlo samples of the weighted regional mean of a gridded field, one batch at a time.
+
+    Each cell is sampled as med + std * N(0, 1). The regional mean of each batch is reduced as soon as
+    it is drawn, so at most `batch_size` * time * cells random numbers are held in memory. Cells that
+    are missing in a time step are left out and the remaining weights are renormalized.
+
+    Parameters:
+    - med: 2D numpy array (time, cells), the per-cell medians.
+    - std: 2D numpy array (time, cells), the per-cell standard deviations.
+    - weights: 1D numpy array (cells,), the non-negative weight of each cell.
+    - n_samples: int, the total number of samples.
+    - batch_size: int, the number of samples drawn at once.
+    - seed: int or numpy SeedSequence, the seed of the random number generator.
+    - correlation: str, one of CORRELATIONS.
+
+    Yields:
+    - 2D numpy array (batch, time) of sampled regional means.
+    """
+    if correlation not in CORRELATIONS:
+        raise ValueError(f"Unknown correlation {correlation!r}, expected one of {CORRELATIONS}")
+    valid = ~(np.isnan(med) | np.isnan(std))
+    cell_weights = np.where(valid, weights[None, :], 0.0)
+    cell_weights /= cell_weights.sum(axis=1, keepdims=True)
+
+    center = np.sum(np.where(valid, med, 0.0) * cell_weights, axis=1)
+    scale = np.where(valid, std, 0.0) * cell_weights
+
+    rng = np.random.default_rng(seed)
+    for start in range(0, n_samples, batch_size):
+        size = min(batch_size, n_samples - start)
+        if correlation == 'full':
+            yield center + rng.standard_normal((size, len(center))) * scale.sum(axis=1)
+        else:
+            draws = rng.standard_normal((size,) + scale.shape)
+            yield center + np.einsum('btc,tc->bt', draws, scale)
+
+def quantile_bands(med, std, weights, quantiles=QUANTILES, n_samples=1000, batch_size=100, seed=0,
+                   correlation='independent'):
+    """
+    Compute empirical quantiles of the regional mean from streamed Monte Carlo samples.
+
+    Only the sampled regional means (n_samples, time) are kept, never the sampled fields.
+
+    Parameters:
+    - med, std, weights, n_samples, batch_size, seed, correlation: as in sample_regional_means.
+    - quantiles: sequence of floats in [0, 1].
+
+    Returns:
+    - 2D numpy array (quantiles, time).
+    """
+    samples = np.empty((n_samples, med.shape[0]))
+    start = 0
+    for batch in sample_regional_means(med, std, weights, n_samples, batch_size, seed, correlation):
+        samples[start:start + len(batch)] = batch
+        start += len(batch)
+    return np.quantile(samples, quantiles, axis=0)
+
+def resolve_product(save_path_processed, scenario, file_var, stat, output_format='netcdf'):
+    """
+    Locate a spatial product, falling back to its name in LEGACY_PRODUCTS.
+
+    Returns:
+    - tuple (path, group), as product_path.
+
+    Raises:
+    - FileNotFoundError if neither the product nor its legacy file exists.
+    """
+    path, group = product_path(save_path_processed, scenario, file_var, stat, output_format)
+    if os.path.exists(path):
+        return path, group
+    legacy = LEGACY_PRODUCTS.get((scenario, file_var, stat))
+    if output_format == 'netcdf' and legacy and os.path.exists(f"{save_path_processed}/{legacy}"):
+        return f"{save_path_processed}/{legacy}", None
+    raise FileNotFoundError(f"{path} does not exist; rerun extract_data.py to write the {stat} products "
+                            f"of {scenario}")
+
+def load_product(save_path_processed, scenario, file_var, data_var, stat, output_format='netcdf'):
+    """
+    Load a spatial product written by extract_data as a (time, lat, lon) DataArray.
+    """
+    path, group = resolve_product(save_path_processed, scenario, file_var, stat, output_format)
+    ds = xr.open_zarr(path, group=group) if output_format == 'zarr' else xr.open_dataset(path)
+    with ds:
+        return ds[[data_var, 'latitude']].load()
+
+def band_seeds(seed, scenario):
+    """
+    Derive independent random streams for the variables of a scenario from one seed.
+
+    Each (scenario, variable) pair gets its own child of np.random.SeedSequence(seed), so no two bands
+    reuse the same samples, and the stream of a pair does not depend on which other scenarios are run.
+
+    Parameters:
+    - seed: int, the seed of the whole run.
+    - scenario: str, one of SCENARIOS.
+
+    Returns:
+    - list of numpy SeedSequence, one per variable of FILE_VARS.
+    """
+    scenario_seed = np.random.SeedSequence(seed).spawn(len(SCENARIOS))[SCENARIOS.index(scenario)]
+    return scenario_seed.spawn(len(FILE_VARS))
+
+def scenario_bands(scenario, save_path_processed, quantiles=QUANTILES, n_samples=1000, batch_size=100,
+                   seed=0, correlation='independent', weighting='none', output_format='netcdf'):
+    """
+    Compute the Monte Carlo quantile bands of all variables of a scenario.
+
+    Parameters:
+    - scenario: str, the name of the scenario (e.g., 'historical', 'ssp119').
+    - save_path_processed: str, the directory holding the spatial products.
+    - quantiles, n_samples, batch_size, correlation: as in quantile_bands.
+    - seed: int, the seed from which the random streams of the variables are derived with band_seeds.
+    - weighting: str, one of WEIGHTINGS; 'area' weights the cells by the cosine of their latitude.
+    - output_format: str, the storage of the spatial products, one of OUTPUT_FORMATS.
+
+    Returns:
+    - pandas DataFrame with a 'time' column and the columns returned by band_columns for each variable.
+    """
+    bands = {}
+    for file_var, data_var, stream in zip(FILE_VARS, DATA_VARS, band_seeds(seed, scenario)):
+        med = load_product(save_path_processed, scenario, file_var, data_var, 'med', output_format)
+        std = load_product(save_path_processed, scenario, file_var, data_var, 'std', output_format)
+        n_times = med.sizes['time']
+        if weighting == 'area':
+            weights = np.cos(np.deg2rad(med['latitude'].to_numpy())).ravel()
+        else:
+            weights = np.ones(med['latitude'].size)
+
+        result = quantile_bands(med[data_var].to_numpy().reshape(n_times, -1),
+                                std[data_var].to_numpy().reshape(n_times, -1), weights,
+                                quantiles, n_samples, batch_size, stream, correlation)
+        bands['time'] = med['time'].to_numpy()
+        column = COLUMN_PREFIXES.get(data_var, data_var)
+        bands.update(zip(band_columns(column, quantiles), result))
+    return pd.DataFrame(bands)
+
+def load_bands(temporal_dir, scenarios):
+    """
+    Load the bands written by this script.
+
+    Parameters:
+    - temporal_dir: str, the directory holding the temporal products.
+    - scenarios: dict mapping labels to scenario names.
+
+    Returns:
+    - dict of pandas DataFrames keyed by label.
+    """
+    return {label: pd.read_csv(f"{temporal_dir}/bands/{scenario}.csv") for label, scenario in scenarios.items()}
+
+def main(n_samples=1000, batch_size=100, seed=0, correlation='independent', weighting='none',
+         output_format='netcdf', data_root='../data'):
+    """
+    Compute and save the Monte Carlo bands of all scenarios.
+
+    Parameters:
+    - n_samples, batch_size, seed, correlation, weighting, output_format: as in scenario_bands.
+    - data_root: str, the data directory holding processed/spa; the bands are written to
+      processed/temporal/bands.
+    """
+    save_path_processed = f'{data_root}/processed/spa'
+    save_path_bands = f'{data_root}/processed/temporal/bands'
+    os.makedirs(save_path_bands, exist_ok=True)
+
+    for scenario in SCENARIOS:
+        df = scenario_bands(scenario, save_path_processed, n_samples=n_samples, batch_size=batch_size,
+                            seed=seed, correlation=correlation, weighting=weighting,
+                            output_format=output_format)
+        df.to_csv(f"{save_path_bands}/{scenario}.csv", index=False)
+        print(f"Saved Monte Carlo bands for {scenario}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Monte Carlo uncertainty bands of the regional means.")
+    parser.add_argument("--samples", type=int, default=1000, help="number of Monte Carlo samples")
+    parser.add_argument("--batch-size", type=int, default=100,
+                        help="samples drawn at once; bounds memory to batch-size x time x cells values")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random number generator")
+    parser.add_argument("--correlation", choices=CORRELATIONS, default='independent',
+                        help="cell-to-cell correlation of the sampled errors")
+    parser.add_argument("--weighting", choices=WEIGHTINGS, default='none',
+                        help="regional-mean reduction: plain lat/lon mean or cos-latitude weighted mean")
+    parser.add_argument("--format", dest="output_format", choices=OUTPUT_FORMATS, default='netcdf',
+                        help="storage of the spatial products written by extract_data")
+    parser.add_argument("--data-root", default='../data',
+                        help="data directory holding processed/spa and receiving processed/temporal/bands")
+    args = parser.parse_args()
+    main(n_samples=args.samples, batch_size=args.batch_size, seed=args.seed, correlation=args.correlation,
+         weighting=args.weighting, output_format=args.output_format, data_root=args.data_root)
@@ -9,74 +9,172 @@ Email: sandy.herho@email.ucr.edu
 Date: 03/29/2024
 """
 
+import hashlib
+import os
+
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-plt.style.use("bmh")
 
-class ClimateDataAnalyzer:
+import instrument
+from figure_cache import pyplot
+from temporal_store import TemporalStore
+
+# Columnar store of the forcing CSV files, kept with the processed data instead of next to the inputs
+FORCING_CACHE = "../data/processed/forcing_store"
+
+def cache_store(cache_dir, directory):
     """
-    A class for analyzing and plotting climate data.
+    Name the store of an input directory inside a cache directory, e.g. rf-1a2b3c4d.
+
+    Returns:
+    - str, or None without a cache directory.
     """
+    if cache_dir is None:
+        return None
+    key = hashlib.sha1(os.path.abspath(directory).encode()).hexdigest()[:8]
+    return f"{cache_dir}/{os.path.basename(os.path.abspath(directory))}-{key}"
 
-    def __init__(self, file_paths):
-        """
-        Initializes the ClimateDataAnalyzer with file paths.
+class ScenarioMatrix:
+    """
+    A scenario x year matrix of one forcing variable on a shared year axis.
 
-        Parameters:
-            file_paths (dict): A dictionary mapping dataset names to file paths.
+    Attributes:
+        names (list): The scenario names, one per row.
+        years (numpy.ndarray): The shared, ascending year axis, one per column.
+        values (numpy.ndarray): The (scenario, year) values, NaN where a scenario has no data.
+    """
+
+    def __init__(self, names, years, values):
         """
-        self.file_paths = file_paths
-        self.data_frames = {}
-        self.stats = {}
+        Initializes the matrix from its rows, columns and values.
+        """
+        self.names = list(names)
+        self.years = np.asarray(years)
+        self.values = np.asarray(values, dtype=float)
 
-    def load_data(self, file_path):
+    @classmethod
+    def from_files(cls, file_paths, column="data_mean_global", min_year=None, max_year=2100, cache_dir=None):
         """
-        Loads climate data from a CSV file and limits it to the year 2100.
+        Builds the matrix from the forcing CSV files, optionally read through their cached binary form.
+
+        With a cache directory, each CSV is parsed once into a columnar store under it (see temporal_store)
+        and memory-mapped afterwards; without one, the CSV files are parsed into memory. The directories
+        of the CSV files are never written to. The year bounds are applied to the sorted year column
+        before any value is read, so only the rows inside the bounds are loaded.
 
         Parameters:
-            file_path (str): The file path to load the data from.
+            file_paths (dict): A dictionary mapping dataset names to CSV file paths.
+            column (str): The variable to load. Default is "data_mean_global".
+            min_year (int): The first year to keep. Default keeps all years.
+            max_year (int): The last year to keep. Default is 2100.
+            cache_dir (str): Directory receiving one store per input directory. Default is None.
 
         Returns:
-            pd.DataFrame: The loaded and filtered data frame.
+            ScenarioMatrix: The matrix of the selected years.
         """
-        df = pd.read_csv(file_path, usecols=["year", "data_mean_global"])
-        df = df[df["year"] <= 2100]  # Filter data to include only years up to 2100
-        return df
-
-    def find_max_min_values(self, df):
+        stores = {}
+        series = {}
+        for name, path in file_paths.items():
+            directory, filename = os.path.split(path)
+            if directory not in stores:
+                stores[directory] = TemporalStore(directory, store_dir=cache_store(cache_dir, directory),
+                                                  cache=cache_dir is not None)
+            store = stores[directory]
+            scenario = os.path.splitext(filename)[0]
+            years = store.column(scenario, "year")
+            start = 0 if min_year is None else np.searchsorted(years, min_year, side="left")
+            stop = len(years) if max_year is None else np.searchsorted(years, max_year, side="right")
+            series[name] = (np.asarray(years[start:stop]), np.asarray(store.column(scenario, column)[start:stop]))
+
+        years = np.unique(np.concatenate([years for years, _ in series.values()])).astype(int)
+        values = np.full((len(series), len(years)), np.nan)
+        for row, (scenario_years, scenario_values) in enumerate(series.values()):
+            values[row, np.searchsorted(years, scenario_years)] = scenario_values
+        return cls(series, years, values)
+
+    def summary(self):
         """
-        Finds the max and min values in the 'data_mean_global' column of a DataFrame.
+        Computes the summary statistics of all scenarios in one vectorized pass.
 
-        Parameters:
-            df (pd.DataFrame): The data frame to analyze.
+        Growth rates are the year-to-year differences; the cumulative forcing is the sum over the
+        years of each scenario, in units of the variable times years.
 
         Returns:
-            dict: A dictionary with the max and min values and corresponding years.
+            pd.DataFrame: One row per scenario with the columns max_value, max_year, min_value,
+                min_year, cumulative, mean_growth_rate, max_growth_rate and max_growth_year.
+        """
+        rows = np.arange(len(self.names))
+        valid = ~np.isnan(self.values)
+        max_index = np.nanargmax(self.values, axis=1)
+        min_index = np.nanargmin(self.values, axis=1)
+
+        first = valid.argmax(axis=1)
+        last = valid.shape[1] - 1 - valid[:, ::-1].argmax(axis=1)
+        growth = np.diff(self.values, axis=1) / np.diff(self.years)
+        growth_index = np.nanargmax(np.where(np.isnan(growth), -np.inf, growth), axis=1)
+
+        return pd.DataFrame({
+            'max_value': self.values[rows, max_index],
+            'max_year': self.years[max_index],
+            'min_value': self.values[rows, min_index],
+            'min_year': self.years[min_index],
+            'cumulative': np.nansum(self.values, axis=1),
+            'mean_growth_rate': ((self.values[rows, last] - self.values[rows, first])
+                                 / (self.years[last] - self.years[first])),
+            'max_growth_rate': growth[rows, growth_index],
+            'max_growth_year': self.years[growth_index + 1],
+        }, index=pd.Index(self.names, name='scenario'))
+
+    def cumulative(self):
         """
-        max_value = df['data_mean_global'].max()
-        min_value = df['data_mean_global'].min()
-        max_year = df.loc[df['data_mean_global'].idxmax(), 'year']
-        min_year = df.loc[df['data_mean_global'].idxmin(), 'year']
-        return {'max_value': max_value, 'max_year': max_year, 'min_value': min_value, 'min_year': min_year}
+        Returns the running sum of each scenario over the years, NaN outside its years.
+        """
+        return np.where(np.isnan(self.values), np.nan, np.nancumsum(self.values, axis=1))
 
-    def process_data(self):
+class ClimateDataAnalyzer:
+    """
+    A class for analyzing and plotting climate data.
+    """
+
+    def __init__(self, file_paths, cache_dir=None):
         """
-        Loads and processes the data for each dataset specified in file_paths.
+        Initializes the ClimateDataAnalyzer with file paths.
+
+        Parameters:
+            file_paths (dict): A dictionary mapping dataset names to file paths.
+            cache_dir (str): Directory of the columnar store of the files, or None to parse them in memory.
         """
-        for name, path in self.file_paths.items():
-            df = self.load_data(path)
-            self.data_frames[name] = df
-            self.stats[name] = self.find_max_min_values(df)
+        self.file_paths = file_paths
+        self.cache_dir = cache_dir
+        self.matrix = None
+        self.summary = None
+        self.stats = {}
 
-    def plot_data(self):
+    def process_data(self):
+        """
+        Loads the data of all datasets up to the year 2100 into a ScenarioMatrix and computes their statistics.
+        """
+        with instrument.stage('load', 'pco2_scenarios'):
+            self.matrix = ScenarioMatrix.from_files(self.file_paths, max_year=2100, cache_dir=self.cache_dir)
+        with instrument.stage('summary', 'pco2_scenarios'):
+            self.summary = self.matrix.summary()
+        columns = {key: self.summary[key].to_numpy() for key in ('max_value', 'max_year', 'min_value', 'min_year')}
+        for row, name in enumerate(self.matrix.names):
+            self.stats[name] = {key: values[row] for key, values in columns.items()}
+
+    def plot_data(self, filename="../figs/fig2.png"):
         """
         Plots the climate data for all datasets.
+
+        Parameters:
+            filename (str): The file the figure is saved to.
         """
+        plt = pyplot()
         plt.figure(figsize=(10, 6))
         ax = plt.gca()  # Get the current axis
 
-        for name, df in self.data_frames.items():
-            ax.plot(df["year"], df["data_mean_global"], label=name)
+        for name, values in zip(self.matrix.names, self.matrix.values):
+            ax.plot(self.matrix.years, values, label=name)
 
         ax.legend(loc="upper left")
         ax.set_xlabel("Time [years]", fontsize=18)
@@ -85,22 +183,29 @@ class ClimateDataAnalyzer:
         plt.xlim(-1, 2102)
         plt.xticks(fontsize=12)  
         plt.yticks(fontsize=12) 
-        plt.savefig("../figs/fig2.png", dpi=400)
+        with instrument.stage('savefig', 'pco2_scenarios'):
+            plt.savefig(filename, dpi=400)
 
-if __name__ == "__main__":
+def main(forcing_dir="../data/pre_processed/rf", figs_dir="../figs", cache_dir=FORCING_CACHE):
+    """
+    Plots the pCO2 pathways of all scenarios and prints their statistics.
+    """
     file_paths = {
-        "Historical": "../data/rf/historical.csv",
-        "SSP 1-1.9": "../data/rf/IMAGE_ssp119.csv",
-        "SSP 1-2.6": "../data/rf/IMAGE_ssp126.csv",
-        "SSP 2-4.5": "../data/rf/MASSAGE_GLOBIOM_ssp245.csv",
-        "SSP 3-7.0": "../data/rf/AIM_ssp370.csv",
-        "SSP 5-8.5": "../data/rf/REMIND_MAGPIE_ssp585.csv"
+        "Historical": f"{forcing_dir}/historical.csv",
+        "SSP 1-1.9": f"{forcing_dir}/IMAGE_ssp119.csv",
+        "SSP 1-2.6": f"{forcing_dir}/IMAGE_ssp126.csv",
+        "SSP 2-4.5": f"{forcing_dir}/MASSAGE_GLOBIOM_ssp245.csv",
+        "SSP 3-7.0": f"{forcing_dir}/AIM_ssp370.csv",
+        "SSP 5-8.5": f"{forcing_dir}/REMIND_MAGPIE_ssp585.csv"
     }
 
-    analyzer = ClimateDataAnalyzer(file_paths)
+    analyzer = ClimateDataAnalyzer(file_paths, cache_dir)
     analyzer.process_data()
-    analyzer.plot_data()
+    analyzer.plot_data(f"{figs_dir}/fig2.png")
 
     # Print statistics, if necessary
     for name, stat in analyzer.stats.items():
         print(f"{name} statistics:\n{stat}\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+"""
+pipeline.py
+Run the processing, statistics and plotting stages as one dependency graph
+
+Author: Sandy Herho
+Email: sandy.herho@email.ucr.edu
+Date: 06/19/2024
+"""
+
+import argparse
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import instrument
+from extract_data import OUTPUT_FORMATS, PRECISIONS, WEIGHTINGS
+
+# Repository directories used when no roots are given, independent of the working directory
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def stage_extract(config):
+    """
+    Extract the Coral Triangle subsets and regional means of the scenarios that are out of date.
+    """
+    import extract_data
+
+    failures = extract_data.run(config['data_root'], workers=config['scenario_workers'],
+                                output_format=config['output_format'], weighting=config['weighting'],
+                                force=config['force'], precision=config['precision'] or 'float64')
+    if failures:
+        raise RuntimeError(f"{len(failures)} extraction task(s) failed")
+
+def stage_anomalies(config):
+    """
+    Build the historical climatology, the projected slices and their anomalies, unless they are up to date.
+    """
+    from anomalies import anomalies_up_to_date, build_anomalies
+
+    save_path_processed = f"{config['data_root']}/processed/spa"
+    anom_path = f"{config['data_root']}/processed/spa_anom"
+    if config['force'] or not anomalies_up_to_date(save_path_processed, anom_path,
+                                                   output_format=config['output_format']):
+        build_anomalies(save_path_processed, anom_path, output_format=config['output_format'])
+
+def stage_temporal_stats(config):
+    """
+    Descriptive statistics, rank tests, boxplots and densities of the regional-mean series.
+    """
+    import temp_stats
+
+    temporal_dir = f"{config['data_root']}/processed/temporal"
+    temp_stats.main(temporal_dir, config['figs_root'], cache_dir=f"{temporal_dir}/stats_cache", show=False)
+
+def stage_spatial_stats(config):
+    """
+    Spatial rank tests of the projected slices and the anomaly maps.
+    """
+    import spa_plot
+
+    spa_plot.main(config['output_format'], workers=config['scenario_workers'], force=config['force'],
+                  data_root=config['data_root'], figs_dir=config['figs_root'], precision=config['precision'])
+
+def stage_figures(config):
+    """
+    Time series figures of the regional means and the pCO2 pathways.
+    """
+    import pco2_scenarios
+    import temp_plot
+    import temporal_anal
+
+    temporal_dir = f"{config['data_root']}/processed/temporal"
+    temp_plot.main(temporal_dir, config['figs_root'], show=False)
+    temporal_anal.main(show=False, force=config['force'], temporal_dir=temporal_dir, figs_dir=config['figs_root'])
+    pco2_scenarios.main(f"{config['data_root']}/pre_processed/rf", config['figs_root'],
+                        cache_dir=f"{config['data_root']}/processed/forcing_store")
+
+def stage_map(config):
+    """
+    Relief map of the study area.
+    """
+    import map as relief_map
+
+    relief_map.main(config['figs_root'], f"{config['data_root']}/relief", show=False)
+
+# Stage name -> (function of the run configuration, stages whose outputs it reads)
+STAGES = {
+    'extract': (stage_extract, []),
+    'anomalies': (stage_anomalies, ['extract']),
+    'temporal_stats': (stage_temporal_stats, ['extract']),
+    'spatial_stats': (stage_spatial_stats, ['anomalies']),
+    'figures': (stage_figures, ['extract']),
+    'map': (stage_map, []),
+}
+
+def downstream(name, stages=STAGES):
+    """
+    List a stage and every stage that depends on it, directly or indirectly.
+    """
+    selected = [name]
+    for other in stages:
+        if other not in selected and any(dep in selected for dep in stages[other][1]):
+            selected.append(other)
+    return selected
+
+def select_stages(only=None, start=None, stages=STAGES):
+    """
+    Choose the stages to run, in the order of `stages`.
+
+    Parameters:
+    - only: list of str, run just these stages; their dependencies are assumed to be up to date.
+    - start: str, run this stage and everything downstream of it.
+    - stages: dict of stage names to (function, dependencies), in dependency order.
+
+    Returns:
+    - list of str, the selected stage names.
+    """
+    selected = list(stages)
+    if start is not None:
+        later = downstream(start, stages)
+        selected = [name for name in selected if name in later]
+    if only:
+        selected = [name for name in selected if name in only]
+    return selected
+
+def execution_waves(selected, stages=STAGES):
+    """
+    Group the selected stages into waves whose stages only depend on earlier waves.
+    """
+    done, waves = set(), []
+    remaining = list(selected)
+    while remaining:
+        wave = [name for name in remaining
+                if all(dep in done or dep not in selected for dep in stages[name][1])]
+        waves.append(wave)
+        done.update(wave)
+        remaining = [name for name in remaining if name not in wave]
+    return waves
+
+def run_stage(name, config):
+    """
+    Run one stage in a worker process and return the wall time it took.
+    """
+    start = time.perf_counter()
+    with instrument.stage(name, 'pipeline'):
+        try:
+            STAGES[name][0](config)
+        except SystemExit as exc:
+            # Scripts report fatal errors with SystemExit, which must not end the worker silently
+            if exc.code not in (None, 0):
+                raise RuntimeError(f"{name} exited with {exc.code}") from None
+    return time.perf_counter() - start
+
+def run_pipeline(selected, config, workers=1, stages=STAGES):
+    """
+    Run the selected stages on a process pool, each as soon as the stages it depends on have finished.
+
+    A failing stage does not stop independent stages; the stages depending on it are skipped.
+
+    Parameters:
+    - selected: list of str, the stages to run.
+    - config: dict with the data_root, figs_root, output_format, weighting, precision, force and
+      scenario_workers of the run.
+    - workers: int, the number of stages run at the same time.
+    - stages: dict of stage names to (function, dependencies).
+
+    Returns:
+    - dict mapping each selected stage to 'done', 'failed' or 'skipped'.
+    """
+    status = {}
+    pending = list(selected)
+    # Figures are rendered headless; spawned workers inherit the backend and never fork HDF5 handles
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        running = {}
+        while pending or running:
+            for name in list(pending):
+                deps = [dep for dep in stages[name][1] if dep in selected]
+                if any(status.get(dep) in ('failed', 'skipped') for dep in deps):
+                    status[name] = 'skipped'
+                    pending.remove(name)
+                    print(f"[{name}] skipped: a stage it depends on failed")
+                elif all(status.get(dep) == 'done' for dep in deps):
+                    print(f"[{name}] started")
+                    running[executor.submit(run_stage, name, config)] = name
+                    pending.remove(name)
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    seconds = future.result()
+                except Exception as exc:
+                    status[name] = 'failed'
+                    print(f"[{name}] failed: {exc!r}")
+                else:
+                    status[name] = 'done'
+                    print(f"[{name}] done in {seconds:.1f} s")
+    return status
+
+def main():
+    """
+    Run the pipeline, or part of it, from the command line.
+    """
+    parser = argparse.ArgumentParser(description="Run the processing, statistics and plotting stages.")
+    parser.add_argument("--data-root", default=f"{REPO_ROOT}/data",
+                        help="directory holding pre_processed/ and receiving processed/")
+    parser.add_argument("--figs-root", default=f"{REPO_ROOT}/figs", help="directory receiving the figures")
+    parser.add_argument("--only", nargs="+", choices=list(STAGES), default=None,
+                        help="run only these stages, assuming the stages they depend on are up to date")
+    parser.add_argument("--from", dest="start", choices=list(STAGES), default=None,
+                        help="run this stage and every stage downstream of it")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="number of stages run at the same time")
+    parser.add_argument("--scenario-workers", type=int, default=1,
+                        help="worker processes of a stage fanning out over scenarios or maps")
+    parser.add_argument("--format", dest="output_format", choices=OUTPUT_FORMATS, default="netcdf",
+                        help="storage of the spatial products")
+    parser.add_argument("--weighting", choices=WEIGHTINGS, default="none",
+                        help="regional-mean reduction: plain lat/lon mean or area-weighted ocean mean")
+    parser.add_argument("--precision", choices=PRECISIONS, default=None,
+                        help="working precision of the extraction and the spatial statistics "
+                             "(default: float64 products, maps as stored)")
+    parser.add_argument("--force", action="store_true", help="rebuild outputs that are up to date")
+    parser.add_argument("--dry-run", action="store_true", help="list the stages in the order they would run")
+    parser.add_argument("--trace", metavar="JSON", default=None,
+                        help="record the time and memory of each stage to a Chrome-trace file")
+    args = parser.parse_args()
+
+    selected = select_stages(args.only, args.start)
+    if args.dry_run:
+        for number, wave in enumerate(execution_waves(selected), start=1):
+            print(f"{number}: {', '.join(wave)}")
+        return
+    if args.trace:
+        instrument.enable(args.trace)
+
+    config = {'data_root': os.path.abspath(args.data_root), 'figs_root': os.path.abspath(args.figs_root),
+              'output_format': args.output_format, 'weighting': args.weighting, 'precision': args.precision,
+              'force': args.force, 'scenario_workers': args.scenario_workers}
+    os.makedirs(config['figs_root'], exist_ok=True)
+    status = run_pipeline(selected, config, workers=max(1, min(args.workers, len(selected))))
+    failed = [name for name, state in status.items() if state != 'done']
+    if failed:
+        raise SystemExit(f"{len(failed)} stage(s) did not complete: {', '.join(failed)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+
+"""
+rank_tests.py
+Batched Kruskal-Wallis and Dunn's tests
+
+Author: Sandy Herho
+Email: sandy.herho@email.ucr.edu
+Date: 05/14/2024
+"""
+
+import numpy as np
+import pandas as pd
+
+# Multiple-comparison corrections for Dunn's test
+P_ADJUST = ['bonferroni', 'holm', 'fdr_bh', None]
+
+def rank_rows(values):
+    """
+    Rank each row of a 2D array with average ranks for ties, using a single argsort.
+
+    Parameters:
+    - values: 2D numpy array (variables, observations) without NaNs.
+
+    Returns:
+    - tuple (ranks, tie_sum): 1-based float ranks with the shape of `values`, and the tie term
+      sum(t**3 - t) over the tie groups of each row.
+    """
+    n_rows, n = values.shape
+    order = np.argsort(values, axis=1, kind='mergesort')
+    ordered = np.take_along_axis(values, order, axis=1)
+
+    # Label runs of equal values with ids that are unique across rows
+    new_run = np.ones(values.shape, dtype=bool)
+    new_run[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+    run_id = np.cumsum(new_run, axis=1) - 1 + (np.arange(n_rows) * n)[:, None]
+
+    counts = np.bincount(run_id.ravel(), minlength=n_rows * n)
+    positions = np.bincount(run_id.ravel(), weights=np.tile(np.arange(n, dtype=float), n_rows),
+                            minlength=n_rows * n)
+    average = np.divide(positions, counts, out=np.zeros_like(positions), where=counts > 0) + 1
+
+    ranks = np.empty(values.shape)
+    np.put_along_axis(ranks, order, average[run_id], axis=1)
+    tie_sum = (counts.astype(float) ** 3 - counts).reshape(n_rows, n).sum(axis=1)
+    return ranks, tie_sum
+
+def adjust_pvalues(p_values, method='bonferroni'):
+    """
+    Correct p-values for multiple comparisons.
+
+    Parameters:
+    - p_values: 1D numpy array of p-values.
+    - method: str, one of P_ADJUST ('bonferroni', 'holm', 'fdr_bh' for Benjamini-Hochberg, or None).
+
+    Returns:
+    - numpy array of adjusted p-values, in the input order.
+    """
+    p_values = np.asarray(p_values, dtype=float)
+    m = p_values.size
+    if method is None or m == 0:
+        return p_values.copy()
+    if method == 'bonferroni':
+        return np.minimum(p_values * m, 1.0)
+
+    order = np.argsort(p_values, kind='mergesort')
+    ordered = p_values[order]
+    if method == 'holm':
+        adjusted = np.maximum.accumulate(ordered * (m - np.arange(m)))
+    elif method == 'fdr_bh':
+        adjusted = np.minimum.accumulate((ordered * m / np.arange(1, m + 1))[::-1])[::-1]
+    else:
+        raise ValueError(f"Unknown p-value adjustment {method!r}, expected one of {P_ADJUST}")
+    result = np.empty(m)
+    result[order] = np.minimum(adjusted, 1.0)
+    return result
+
+def kruskal_dunn(values, codes, n_groups):
+    """
+    Kruskal-Wallis H test and Dunn's pairwise z-scores for one or more variables sharing the same groups.
+
+    The ranks and the tie correction are computed once per variable and shared by both tests.
+
+    Parameters:
+    - values: 2D numpy array (variables, observations) without NaNs.
+    - codes: 1D integer array with the group index of each observation.
+    - n_groups: int, the number of groups.
+
+    Returns:
+    - dict with 'H' and 'kw_pvalue' (one value per variable), and 'z' and 'p_value', the Dunn
+      z-scores and unadjusted two-sided p-values (variables, groups, groups).
+    """
+    import scipy.stats as stats
+
+    ranks, tie_sum = rank_rows(values)
+    n = values.shape[1]
+    sizes = np.bincount(codes, minlength=n_groups).astype(float)
+    rank_sums = np.stack([np.bincount(codes, weights=row, minlength=n_groups) for row in ranks])
+
+    h = 12.0 / (n * (n + 1)) * np.sum(rank_sums ** 2 / sizes, axis=1) - 3 * (n + 1)
+    h /= 1 - tie_sum / (n ** 3 - n)
+    kw_pvalue = stats.chi2.sf(h, n_groups - 1)
+
+    mean_ranks = rank_sums / sizes
+    variance = n * (n + 1) / 12.0 - tie_sum / (12.0 * (n - 1))
+    scale = np.sqrt(variance[:, None, None] * (1 / sizes[:, None] + 1 / sizes[None, :]))
+    z = (mean_ranks[:, :, None] - mean_ranks[:, None, :]) / scale
+    p_value = 2 * stats.norm.sf(np.abs(z))
+    return {'H': h, 'kw_pvalue': kw_pvalue, 'z': z, 'p_value': p_value}
+
+def rank_tests(data, p_adjust='bonferroni'):
+    """
+    Run Kruskal-Wallis and Dunn's tests for several variables in one call.
+
+    Missing values are dropped per group. Variables with the same group sizes are stacked and ranked
+    together.
+
+    Parameters:
+    - data: dict mapping each variable to a dict of array-likes keyed by group label.
+      All variables must use the same group labels.
+    - p_adjust: str, the correction applied to Dunn's p-values within each variable, one of P_ADJUST.
+
+    Returns:
+    - pandas DataFrame with one row per variable and pair of groups, and the columns 'variable',
+      'group1', 'group2', 'H', 'kw_pvalue', 'z', 'p_value' and 'p_adjusted'.
+    """
+    variables = list(data)
+    labels = list(data[variables[0]])
+    n_groups = len(labels)
+
+    samples = {}
+    for variable in variables:
+        groups = [np.asarray(data[variable][label], dtype=float) for label in labels]
+        samples[variable] = [group[~np.isnan(group)] for group in groups]
+
+    # Batch the variables whose groups have the same sizes
+    batches = {}
+    for variable in variables:
+        batches.setdefault(tuple(len(group) for group in samples[variable]), []).append(variable)
+
+    results = {}
+    for sizes, batch in batches.items():
+        codes = np.repeat(np.arange(n_groups), sizes)
+        values = np.stack([np.concatenate(samples[variable]) for variable in batch])
+        batch_results = kruskal_dunn(values, codes, n_groups)
+        for i, variable in enumerate(batch):
+            results[variable] = {key: value[i] for key, value in batch_results.items()}
+
+    return pd.concat([tidy_table(variable, labels, results[variable], p_adjust) for variable in variables],
+                     ignore_index=True)
+
+def tidy_table(variable, labels, result, p_adjust='bonferroni'):
+    """
+    Arrange the test results of one variable as rows of pairs of groups.
+
+    Parameters:
+    - variable: str, the name of the variable.
+    - labels: list of str, the group labels.
+    - result: dict with the results of one variable, as returned by kruskal_dunn.
+    - p_adjust: str, the correction applied to Dunn's p-values, one of P_ADJUST.
+
+    Returns:
+    - pandas DataFrame with the columns described in rank_tests.
+    """
+    first, second = np.triu_indices(len(labels), k=1)
+    p_value = result['p_value'][first, second]
+    return pd.DataFrame({
+        'variable': variable,
+        'group1': np.asarray(labels, dtype=object)[first],
+        'group2': np.asarray(labels, dtype=object)[second],
+        'H': result['H'],
+        'kw_pvalue': result['kw_pvalue'],
+        'z': result['z'][first, second],
+        'p_value': p_value,
+        'p_adjusted': adjust_pvalues(p_value, p_adjust),
+    })
+
+def lag1_autocorrelation(grid):
+    """
+    Estimate the lag-1 spatial autocorrelation of a 2D field from its zonal and meridional neighbours.
+
+    Parameters:
+    - grid: 2D numpy array, NaN over land.
+
+    Returns:
+    - float, the correlation between adjacent ocean cells.
+    """
+    anomaly = grid - np.nanmean(grid)
+    variance = np.nanmean(anomaly ** 2)
+    products = np.concatenate([(anomaly[:, :-1] * anomaly[:, 1:]).ravel(),
+                               (anomaly[:-1, :] * anomaly[1:, :]).ravel()])
+    products = products[~np.isnan(products)]
+    if variance == 0 or products.size == 0:
+        return 0.0
+    return float(np.mean(products) / variance)
+
+def spatial_rank_tests(grids, labels, variable='value', p_adjust='bonferroni', block=1,
+                       effective_size=False):
+    """
+    Kruskal-Wallis and Dunn's tests comparing the ocean cells of several gridded fields.
+
+    The ocean cells of all grids are gathered into one preallocated array and ranked with a single
+    argsort, so memory stays linear in the number of ocean cells. Neighbouring cells are not
+    independent; this can be accounted for by subsampling every `block`-th cell in both directions,
+    or by scaling the statistics to an effective sample size n * (1 - r) / (1 + r), where r is the
+    mean lag-1 spatial autocorrelation of the grids.
+
+    Parameters:
+    - grids: list of 2D array-likes (lat, lon), NaN over land, one per group.
+    - labels: list of str, the group labels.
+    - variable: str, the name of the variable in the result table.
+    - p_adjust: str, the correction applied to Dunn's p-values, one of P_ADJUST.
+    - block: int, keep every `block`-th cell along each axis (1 keeps all cells).
+    - effective_size: bool, scale H and the z-scores to the effective sample size.
+
+    Returns:
+    - pandas DataFrame with the columns described in rank_tests.
+    """
+    grids = [np.asarray(grid, dtype=float)[::block, ::block] for grid in grids]
+    masks = [~np.isnan(grid) for grid in grids]
+    sizes = [int(mask.sum()) for mask in masks]
+
+    values = np.empty(sum(sizes))
+    start = 0
+    for grid, mask, size in zip(grids, masks, sizes):
+        values[start:start + size] = grid[mask]
+        start += size
+    codes = np.repeat(np.arange(len(grids), dtype=np.int32), sizes)
+
+    result = {key: value[0] for key, value in kruskal_dunn(values[None, :], codes, len(grids)).items()}
+
+    if effective_size:
+        import scipy.stats as stats
+
+        r = np.mean([lag1_autocorrelation(grid) for grid in grids])
+        factor = float(np.clip((1 - r) / (1 + r), 1.0 / values.size, 1.0))
+        result['H'] = result['H'] * factor
+        result['kw_pvalue'] = stats.chi2.sf(result['H'], len(grids) - 1)
+        result['z'] = result['z'] * np.sqrt(factor)
+        result['p_value'] = 2 * stats.norm.sf(np.abs(result['z']))
+
+    return tidy_table(variable, labels, result, p_adjust)
+
+def dunn_matrix(results, variable, labels=None, column='p_adjusted'):
+    """
+    Arrange the pairwise results of one variable as a symmetric matrix, as returned by scikit_posthocs.
+
+    Parameters:
+    - results: pandas DataFrame returned by rank_tests.
+    - variable: str, the variable to select.
+    - labels: list of str, the group order (default: order of appearance).
+    - column: str, the column to arrange, e.g. 'p_adjusted', 'p_value' or 'z'.
+
+    Returns:
+    - pandas DataFrame indexed by group on both axes, with ones on the diagonal for p-values.
+    """
+    rows = results[results['variable'] == variable]
+    if labels is None:
+        labels = list(dict.fromkeys(list(rows['group1']) + list(rows['group2'])))
+    matrix = pd.DataFrame(0.0 if column == 'z' else 1.0, index=labels, columns=labels)
+    sign = -1.0 if column == 'z' else 1.0
+    for group1, group2, value in zip(rows['group1'], rows['group2'], rows[column]):
+        matrix.loc[group1, group2] = value
+        matrix.loc[group2, group1] = sign * value
+    return matrix
+
+def kruskal_summary(results):
+    """
+    Return the Kruskal-Wallis statistic and p-value of each variable from a rank_tests result table.
+    """
+    return results.groupby('variable', sort=False)[['H', 'kw_pvalue']].first()
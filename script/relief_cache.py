@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+
+"""
+relief_cache.py
+Local tile cache and resolution pyramid of the Earth relief grid
+
+Author: Sandy Herho
+Email: sandy.herho@email.ucr.edu
+Date: 06/03/2024
+"""
+
+import argparse
+import math
+import os
+import warnings
+
+import numpy as np
+import xarray as xr
+
+# GMT resolution codes of the Earth relief datasets -> grid spacing in arc-seconds, finest first
+RESOLUTIONS = {
+    '15s': 15, '30s': 30, '01m': 60, '02m': 120, '03m': 180, '04m': 240, '05m': 300, '06m': 360,
+    '10m': 600, '15m': 900, '20m': 1200, '30m': 1800, '01d': 3600,
+}
+
+# Edge length of a cached tile in degrees; a multiple of every grid spacing above
+TILE_SIZE = 10
+
+# Reductions of a block of relief cells to one cell
+DECIMATION_METHODS = ['mean', 'median']
+
+# Number of input cells read from disk at a time when decimating
+BLOCK_CELLS = 1 << 22
+
+def required_resolution(region, width_cm, dpi, levels=RESOLUTIONS):
+    """
+    Choose the coarsest grid spacing that still gives at least one grid cell per output pixel.
+
+    Parameters:
+    - region: list [west, east, south, north] in degrees.
+    - width_cm: float, the width of the map on the page in centimeters.
+    - dpi: int, the resolution of the saved figure.
+    - levels: dict of resolution codes and spacings in arc-seconds to choose from.
+
+    Returns:
+    - str resolution code, e.g. '02m'. The finest level if none is fine enough.
+    """
+    pixels = width_cm / 2.54 * dpi
+    spacing = (region[1] - region[0]) * 3600 / pixels
+    fine_enough = [code for code, seconds in levels.items() if seconds <= spacing]
+    if not fine_enough:
+        return min(levels, key=levels.get)
+    return max(fine_enough, key=levels.get)
+
+def decimation_factor(region, width_cm, dpi, resolution):
+    """
+    Choose the block size that reduces a level of the pyramid to about one cell per output pixel.
+
+    The factor divides the number of cells along a tile edge, so the decimated tiles still line up.
+
+    Parameters:
+    - region: list [west, east, south, north] in degrees.
+    - width_cm: float, the width of the map on the page in centimeters.
+    - dpi: int, the resolution of the saved figure.
+    - resolution: str, the resolution code of the grid to decimate.
+
+    Returns:
+    - int factor, 1 if the grid is not finer than the output pixels.
+    """
+    spacing = (region[1] - region[0]) * 3600 / (width_cm / 2.54 * dpi)
+    cells = TILE_SIZE * 3600 // RESOLUTIONS[resolution]
+    target = max(1, int(spacing // RESOLUTIONS[resolution]))
+    return max(factor for factor in range(1, target + 1) if cells % factor == 0)
+
+def decimate(path, factor, method='mean', block_cells=BLOCK_CELLS):
+    """
+    Block-reduce a relief grid file by an integer factor, streaming blocks of rows from disk.
+
+    The file is opened lazily, so each block reads only its own rows; at most `block_cells` input
+    cells and the reduced grid are held in memory. Rows and columns beyond a multiple of `factor`
+    are dropped.
+
+    Parameters:
+    - path: str, a NetCDF file holding one (lat, lon) or (y, x) grid.
+    - factor: int, the number of input cells along each edge of a block.
+    - method: str, one of DECIMATION_METHODS.
+    - block_cells: int, the approximate number of input cells read at a time.
+
+    Returns:
+    - xarray DataArray (lat, lon) with the block means or medians at the block centers.
+    """
+    if method not in DECIMATION_METHODS:
+        raise ValueError(f"Unknown decimation method {method!r}, expected one of {DECIMATION_METHODS}")
+    reduce = np.nanmedian if method == 'median' else np.nanmean
+    with xr.open_dataarray(path) as grid:
+        grid = standardize(grid)
+        n_lat, n_lon = grid.sizes['lat'] // factor, grid.sizes['lon'] // factor
+        reduced = np.empty((n_lat, n_lon), dtype=np.float32)
+        step = max(1, block_cells // (grid.sizes['lon'] * factor * factor))
+
+        for start in range(0, n_lat, step):
+            stop = min(start + step, n_lat)
+            block = grid.isel(lat=slice(start * factor, stop * factor), lon=slice(0, n_lon * factor)).to_numpy()
+            with warnings.catch_warnings():
+                # All-missing blocks stay NaN
+                warnings.simplefilter("ignore", category=RuntimeWarning)
+                reduced[start:stop] = reduce(block.reshape(stop - start, factor, n_lon, factor), axis=(1, 3))
+
+        lat = grid['lat'].to_numpy()[:n_lat * factor].reshape(n_lat, factor).mean(axis=1)
+        lon = grid['lon'].to_numpy()[:n_lon * factor].reshape(n_lon, factor).mean(axis=1)
+        return xr.DataArray(reduced, coords={'lat': lat, 'lon': lon}, dims=('lat', 'lon'), name=grid.name)
+
+def tile_bounds(region):
+    """
+    List the (south, west) corners of the tiles covering a region.
+    """
+    west, east, south, north = region
+    lons = range(math.floor(west / TILE_SIZE) * TILE_SIZE, math.ceil(east / TILE_SIZE) * TILE_SIZE, TILE_SIZE)
+    lats = range(math.floor(south / TILE_SIZE) * TILE_SIZE, math.ceil(north / TILE_SIZE) * TILE_SIZE, TILE_SIZE)
+    return [(lat, lon) for lat in lats for lon in lons]
+
+def standardize(grid):
+    """
+    Name the horizontal dims of a relief grid lon/lat and sort them in ascending order.
+    """
+    grid = grid.rename({name: new for name, new in (('x', 'lon'), ('y', 'lat')) if name in grid.dims})
+    return grid.sortby('lat').sortby('lon')
+
+class ReliefCache:
+    """
+    Tiles of the Earth relief at several resolutions, built once from a base grid and read back from disk.
+
+    Every tile covers TILE_SIZE degrees and is stored for each level of the pyramid as
+    `{cache_dir}/{resolution}/tile_{south}_{west}.nc`. A tile is built from a single read of the base
+    grid: the source is block-averaged to every coarser level in one pass, so at most one base tile is
+    held in memory. The base grid comes from a local NetCDF file, which makes the cache work offline,
+    or, without one, from pygmt.datasets.load_earth_relief.
+
+    Attributes:
+        cache_dir (str): Directory holding the tiles.
+        source (str): Local relief grid (NetCDF) on a regular pixel-registered lon/lat grid, or None.
+        base (str): Resolution code of the base grid; read from the spacing of `source` if given.
+    """
+
+    def __init__(self, cache_dir='../data/relief', source=None, base='15s'):
+        """
+        Initializes the cache.
+        """
+        self.cache_dir = cache_dir
+        self.source = source
+        self.base = base
+        if source is not None:
+            with xr.open_dataarray(source) as grid:
+                grid = standardize(grid)
+                seconds = round(float(np.diff(grid['lon'][:2])[0]) * 3600)
+            self.base = next((code for code, value in RESOLUTIONS.items() if value == seconds), None)
+            if self.base is None:
+                raise ValueError(f"{source} has a spacing of {seconds} arc-seconds, expected one of {RESOLUTIONS}")
+
+    def levels(self):
+        """
+        Return the resolution codes available from the base grid, finest first.
+        """
+        base_seconds = RESOLUTIONS[self.base]
+        return {code: seconds for code, seconds in RESOLUTIONS.items()
+                if seconds >= base_seconds and seconds % base_seconds == 0
+                and (TILE_SIZE * 3600) % seconds == 0}
+
+    def tile_path(self, resolution, lat, lon):
+        """
+        Build the path of a cached tile.
+        """
+        return f"{self.cache_dir}/{resolution}/tile_{lat:+03d}_{lon:+04d}.nc"
+
+    def read_base(self, lat, lon):
+        """
+        Read one tile of the base grid, from the local source or through PyGMT.
+        """
+        # Longitudes east of 180 are read from the -180..180 grid and shifted back
+        shift = 360 if lon >= 180 else 0
+        west, east = lon - shift, lon - shift + TILE_SIZE
+        if self.source is not None:
+            with xr.open_dataarray(self.source) as grid:
+                grid = standardize(grid)
+                tile = grid.sel(lon=slice(west, east), lat=slice(lat, lat + TILE_SIZE)).load()
+        else:
+            import pygmt
+            tile = standardize(pygmt.datasets.load_earth_relief(
+                resolution=self.base, region=[west, east, lat, lat + TILE_SIZE], registration="pixel"))
+        return tile.assign_coords(lon=tile['lon'] + shift).astype(np.float32)
+
+    def build_tile(self, lat, lon):
+        """
+        Build all levels of one tile from a single read of the base grid.
+        """
+        tile = self.read_base(lat, lon)
+        for code, seconds in self.levels().items():
+            factor = seconds // RESOLUTIONS[self.base]
+            level = tile.coarsen(lat=factor, lon=factor, boundary='trim').mean() if factor > 1 else tile
+            path = self.tile_path(code, lat, lon)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            level.rename('z').to_netcdf(f"{path}.tmp", encoding={'z': {'zlib': True, 'dtype': 'float32'}})
+            os.replace(f"{path}.tmp", path)
+
+    def build(self, region, force=False):
+        """
+        Precompute the pyramid of all tiles covering a region, e.g. before working offline.
+        """
+        for lat, lon in tile_bounds(region):
+            if force or not all(os.path.exists(self.tile_path(code, lat, lon)) for code in self.levels()):
+                self.build_tile(lat, lon)
+
+    def load(self, region, resolution, factor=1, method='mean'):
+        """
+        Load the relief of a region at one level of the pyramid, building missing tiles first.
+
+        Parameters:
+        - region: list [west, east, south, north] in degrees.
+        - resolution: str, one of the codes returned by `levels`.
+        - factor: int, block-reduce each tile by this factor while reading it (see `decimate`);
+          must divide the number of cells along a tile edge.
+        - method: str, the block reduction, one of DECIMATION_METHODS.
+
+        Returns:
+        - xarray DataArray (lat, lon) of the relief in meters.
+        """
+        if resolution not in self.levels():
+            raise ValueError(f"Resolution {resolution!r} is not available from a {self.base} base grid, "
+                             f"expected one of {list(self.levels())}")
+        if (TILE_SIZE * 3600 // RESOLUTIONS[resolution]) % factor:
+            raise ValueError(f"Decimation factor {factor} does not divide the "
+                             f"{TILE_SIZE * 3600 // RESOLUTIONS[resolution]} cells of a {resolution} tile")
+        tiles = []
+        for lat, lon in tile_bounds(region):
+            path = self.tile_path(resolution, lat, lon)
+            if not os.path.exists(path):
+                self.build_tile(lat, lon)
+            if factor > 1:
+                tiles.append(decimate(path, factor, method))
+                continue
+            with xr.open_dataarray(path) as tile:
+                tiles.append(tile.load())
+        grid = xr.combine_by_coords(tiles)
+        if isinstance(grid, xr.Dataset):
+            grid = grid['z']
+        west, east, south, north = region
+        return grid.sel(lon=slice(west, east), lat=slice(south, north))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute the relief pyramid of a region.")
+    parser.add_argument("--source", default=None, help="local relief grid (NetCDF); default downloads via PyGMT")
+    parser.add_argument("--region", type=float, nargs=4, default=[95, 191, -25, 30],
+                        metavar=("WEST", "EAST", "SOUTH", "NORTH"), help="region to cache in degrees")
+    parser.add_argument("--cache-dir", default="../data/relief", help="directory holding the tiles")
+    parser.add_argument("--force", action="store_true", help="rebuild tiles that already exist")
+    args = parser.parse_args()
+    ReliefCache(args.cache_dir, source=args.source).build(args.region, force=args.force)
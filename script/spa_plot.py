@@ -9,33 +9,63 @@ Sandy Herho <sandy.herho@email.ucr.edu>
 04/20/24
 """
 
+import argparse
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import xarray as xr
-import matplotlib.pyplot as plt
-import matplotlib.colors as mcolors
-import scipy.stats as stats
-import scikit_posthocs as sp
 
-plt.style.use('bmh')
+from anomalies import anomalies_up_to_date, anomaly_path, build_anomalies, climatology_path, slice_path
+import instrument
+from figure_cache import FigureRegistry, pyplot
+from rank_tests import dunn_matrix, spatial_rank_tests
+from time_reductions import reduce_time, select_time
+
+# Map figures already built in this process, keyed by layout
+_RENDERERS = {}
 
 # Function to load dataset and select data
-def load_and_select_data(filepath, variable, time=None, mean_dim=None):
+def load_and_select_data(filepath, variable, time=None, mean_dim=None, group=None, reduction=None,
+                         percentile=None, precision=None):
     """
-    Load data from a NetCDF file, select a variable and optionally select a specific time or average over a dimension.
+    Load data from a NetCDF file or Zarr store, select a variable and optionally select a specific time
+    or reduce over a dimension. The file is opened lazily, so selecting a time slice only reads and
+    decompresses that slice, and reductions over time are accumulated block by block (see
+    time_reductions.reduce_time) instead of loading the whole cube.
+
+    Parameters:
+    - time: the time step to select, e.g. 2100 on the decimal-year axes of the products.
+    - mean_dim: str or list, the dimensions to average over.
+    - reduction: str, a reduction over time, one of time_reductions.REDUCTIONS.
+    - percentile: float in [0, 100], the percentile of the 'percentile' reduction.
+    - precision: str, the dtype of the returned values, e.g. "float32"; None keeps the stored dtype.
+      Reductions still accumulate in float64.
     """
-    ds = xr.open_dataset(filepath)
-    data = ds[variable]
-    if time:
-        data = data.sel(time=time)
-    if mean_dim:
-        data = data.mean(dim=mean_dim)
-    return data
+    if str(filepath).endswith(".zarr"):
+        ds = xr.open_zarr(filepath, group=group)
+    else:
+        ds = xr.open_dataset(filepath)
+    with ds:
+        data = ds[variable]
+        dtype = precision or data.dtype
+        if time is not None:
+            data = select_time(data, time)
+        if reduction:
+            data = reduce_time(data, reduction, percentile)
+        if mean_dim in ("time", ["time"], ("time",)):
+            data = reduce_time(data, "mean")
+        elif mean_dim:
+            data = data.mean(dim=mean_dim, dtype="float64")
+        return data.load().astype(dtype, copy=False)
 
 # Function to plot data
 def plot_data(data, bounds, filename, label, delta=False, vmin=None, vmax=None):
     """
     Plot 2D geographical data with a colormap, including a colorbar and annotations.
     """
+    plt = pyplot()
     plt.figure(figsize=(10, 5))
     cmap = plt.cm.coolwarm_r.copy()
     cmap.set_bad('#402206')
@@ -49,23 +79,126 @@ def plot_data(data, bounds, filename, label, delta=False, vmin=None, vmax=None):
     plt.savefig(filename, dpi=450)
     plt.close()
 
-def main():
+class MapRenderer:
+    """
+    Headless map figure that is built once and redrawn for each map with the same layout.
+
+    The figure is not attached to pyplot, so rendering never opens or blocks on a display. Each new
+    map only replaces the image data, color limits and colorbar label; the figure, axes, `imshow`
+    artist and colorbar are reused.
+
+    Attributes:
+        figure (matplotlib.figure.Figure): The figure, rendered with the Agg canvas.
+        image (matplotlib.image.AxesImage): The map artist.
+        colorbar (matplotlib.colorbar.Colorbar): The colorbar of the map.
+        vmin, vmax (float): Fixed color limits, or None to scale each map to its data.
+    """
+    def __init__(self, data, bounds, label, delta=False, vmin=None, vmax=None):
+        """
+        Builds the figure with a first map, laid out as in plot_data.
+        """
+        from matplotlib.figure import Figure
+
+        plt = pyplot()
+        self.vmin, self.vmax = vmin, vmax
+        self.figure = Figure(figsize=(10, 5))
+        ax = self.figure.add_subplot()
+        cmap = plt.cm.coolwarm_r.copy()
+        cmap.set_bad('#402206')
+        self.image = ax.imshow(data, extent=[bounds[1].min(), bounds[1].max(), bounds[0].min(), bounds[0].max()],
+                               cmap=cmap, aspect='auto', origin='lower', vmin=vmin, vmax=vmax)
+        self.colorbar = self.figure.colorbar(self.image, label=label,
+                                             boundaries=np.linspace(vmin, vmax, 8) if delta else None)
+        self.colorbar.set_label(label, size=15)
+        self.colorbar.ax.tick_params(labelsize=12)
+        ax.set_xlabel('Longitude', fontsize=14)
+        ax.set_ylabel('Latitude', fontsize=14)
+
+    def update(self, data, label):
+        """
+        Replaces the map and the colorbar label.
+        """
+        self.image.set_data(data)
+        masked = np.ma.masked_invalid(data)
+        self.image.set_clim(masked.min() if self.vmin is None else self.vmin,
+                            masked.max() if self.vmax is None else self.vmax)
+        self.colorbar.set_label(label, size=15)
+
+    def save(self, filename):
+        """
+        Renders the figure to a file.
+        """
+        self.figure.savefig(filename, dpi=450)
+
+def render_map(job):
+    """
+    Render one map with the renderer of its layout, building the renderer on first use in this process.
+
+    Parameters:
+    - job: dict with the arguments of plot_data: 'data', 'bounds', 'filename', 'label' and optionally
+      'delta', 'vmin' and 'vmax'.
+
+    Returns:
+    - tuple (filename, seconds), the time taken to draw and save the map.
+    """
+    start = time.perf_counter()
+    data = np.asarray(job['data'])
+    delta, vmin, vmax = job.get('delta', False), job.get('vmin'), job.get('vmax')
+    bounds = job['bounds']
+    key = (data.shape, delta, vmin, vmax, bounds[0].min(), bounds[0].max(), bounds[1].min(), bounds[1].max())
+    with instrument.stage('render_map', 'spa_plot', filename=job['filename']):
+        if key in _RENDERERS:
+            _RENDERERS[key].update(data, job['label'])
+        else:
+            _RENDERERS[key] = MapRenderer(data, bounds, job['label'], delta, vmin, vmax)
+        _RENDERERS[key].save(job['filename'])
+    return job['filename'], time.perf_counter() - start
+
+def render_maps(jobs, workers=1):
+    """
+    Render a batch of maps headlessly, optionally on a process pool, and report the time of each map.
+
+    Parameters:
+    - jobs: list of dicts, as accepted by render_map.
+    - workers: int, the number of worker processes; 1 renders the maps in this process.
+
+    Returns:
+    - list of (filename, seconds) tuples, in the order of `jobs`.
+    """
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            timings = list(executor.map(render_map, jobs))
+    else:
+        timings = [render_map(job) for job in jobs]
+    for filename, seconds in timings:
+        print(f"Rendered {filename} in {seconds:.2f} s")
+    return timings
+
+def main(output_format="netcdf", block=1, effective_size=False, rebuild=False, workers=1, force=False,
+         dry_run=False, data_root="../data", figs_dir="../figs", precision=None):
     # Variables and file paths
     variables = ["pHT", "aragonite", "calcite"]
-    times = [None, "2100", "2100"]
-    means = ["time", None, None]
     prefixes = ["ph", "ar", "cal"]
     suffixes = ["his", "ssp119", "ssp126", "ssp245", "ssp370", "ssp585"]
-    base_path = "../data/processed/spa"
-
-    # Loop through each variable
-    for prefix, variable, time, mean in zip(prefixes, variables, times, means):
-        datasets = {}
-        for suffix in suffixes:
-            path = f"{base_path}/{suffix}_{prefix}_med.nc"
-            data = load_and_select_data(path, variable, time=time, mean_dim=mean)
-            datasets[suffix] = data
-        
+    base_path = f"{data_root}/processed/spa"
+    anom_path = f"{data_root}/processed/spa_anom"
+
+    # Build the climatology and anomaly products when the spatial products changed; later runs read them from disk
+    if rebuild or not anomalies_up_to_date(base_path, anom_path, output_format=output_format):
+        with instrument.stage('build_anomalies', 'spa_plot'):
+            build_anomalies(base_path, anom_path, output_format=output_format)
+
+    # Loop through each variable, declaring the maps and collecting them to render in one batch
+    registry = FigureRegistry(f"{figs_dir}/figures.json")
+    jobs = {}
+    for prefix, variable in zip(prefixes, variables):
+        with instrument.stage('load_slices', 'spa_plot', variable=variable):
+            datasets = {"his": load_and_select_data(climatology_path(anom_path, prefix), variable,
+                                                    precision=precision)}
+            for suffix in suffixes[1:]:
+                datasets[suffix] = load_and_select_data(slice_path(anom_path, prefix, suffix), variable,
+                                                        precision=precision)
+
         # Process historical data
         his_data = datasets["his"].to_numpy()
         lat_bounds = np.linspace(-25, 29, his_data.shape[0])
@@ -73,25 +206,67 @@ def main():
         bounds = [lat_bounds, lon_bounds]
 
         # Plot historical data
-        plot_data(his_data, bounds, f'../figs/fig_{prefix}6a.png', f'{variable} (Historical)')
+        jobs[f'fig_{prefix}6a'] = ({'data': his_data, 'bounds': bounds, 'filename': f'{figs_dir}/fig_{prefix}6a.png',
+                                    'label': f'{variable} (Historical)'}, climatology_path(anom_path, prefix))
 
-        # Process projections and anomalies
+        # Plot the cached anomalies of the projections
         for i, suffix in enumerate(suffixes[1:], start=1):
-            proj_data = datasets[suffix].to_numpy()
-            anomaly = datasets[suffix] - datasets["his"]
-            anomaly_data = anomaly.to_numpy()
-            plot_data(anomaly_data, bounds, f'../figs/fig_{prefix}6{chr(i + 96)}.png',
-                      r'$\Delta${}'.format(variable), delta=True, vmin=-0.6, vmax=-0.04)
+            with instrument.stage('load_anomaly', 'spa_plot', scenario=suffix, variable=variable):
+                anomaly_data = load_and_select_data(anomaly_path(anom_path, prefix, suffix), variable,
+                                                    precision=precision).to_numpy()
+            jobs[f'fig_{prefix}6{chr(i + 97)}'] = ({'data': anomaly_data, 'bounds': bounds,
+                                                   'filename': f'{figs_dir}/fig_{prefix}6{chr(i + 97)}.png',
+                                                   'label': r'$\Delta${}'.format(variable), 'delta': True,
+                                                   'vmin': -0.6, 'vmax': -0.04},
+                                                  anomaly_path(anom_path, prefix, suffix))
 
         # Perform statistical analysis if needed
-        control = his_data.flatten()[~np.isnan(his_data.flatten())]
-        test_datasets = [datasets[s].to_numpy().flatten()[~np.isnan(datasets[s].to_numpy().flatten())] for s in suffixes[1:]]
-        data = [control] + test_datasets
-        stat, p_value = stats.kruskal(*data)
-        if p_value < 0.05:
-            p_values_matrix = sp.posthoc_dunn(data, p_adjust='bonferroni')
+        with instrument.stage('rank_tests', 'spa_plot', variable=variable):
+            tests = spatial_rank_tests([datasets[s].to_numpy() for s in suffixes], suffixes, variable=prefix,
+                                       p_adjust='bonferroni', block=block, effective_size=effective_size)
+        if tests['kw_pvalue'].iloc[0] < 0.05:
+            p_values_matrix = dunn_matrix(tests, prefix, suffixes)
             print(f"Dunn's Test pairwise p-values with Bonferroni correction for {prefix}:\n", p_values_matrix)
 
+    for name, (job, path) in jobs.items():
+        params = {key: value for key, value in job.items() if key not in ('data', 'bounds')}
+        params['bounds'] = [[float(b.min()), float(b.max())] for b in job['bounds']]
+        if precision:
+            params['precision'] = precision
+        registry.register(name, [job['filename']], [path], params, code=MapRenderer)
+
+    if dry_run:
+        registry.dry_run(force)
+        return
+    stale = registry.stale(force)
+    render_maps([jobs[name][0] for name in stale], workers=workers)
+    registry.record(stale)
+
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Plot the spatial products and compare the scenarios.")
+    parser.add_argument("--format", dest="output_format", choices=["netcdf", "zarr"], default="netcdf",
+                        help="storage of the spatial products written by extract_data")
+    parser.add_argument("--block", type=int, default=1,
+                        help="use every n-th grid cell in the rank tests to reduce spatial autocorrelation")
+    parser.add_argument("--effective-size", action="store_true",
+                        help="scale the rank tests to the effective sample size of the autocorrelated grids")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes rendering the maps")
+    parser.add_argument("--rebuild-anomalies", action="store_true",
+                        help="recompute the climatology and anomaly products before plotting")
+    parser.add_argument("--force", action="store_true",
+                        help="render all maps, even those that are up to date")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="list the maps that would be rebuilt without rendering them")
+    parser.add_argument("--precision", choices=["float64", "float32"], default=None,
+                        help="working precision of the loaded maps (default: as stored); the rank statistics "
+                             "are computed in float64")
+    parser.add_argument("--trace", metavar="JSON", default=None,
+                        help="record the time and memory of each stage to a Chrome-trace file")
+    args = parser.parse_args()
+    if args.trace:
+        instrument.enable(args.trace)
+    main(args.output_format, block=args.block, effective_size=args.effective_size,
+         rebuild=args.rebuild_anomalies, workers=args.workers, force=args.force, dry_run=args.dry_run,
+         precision=args.precision)
 
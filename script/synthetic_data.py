@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+"""
+synthetic_data.py
+Synthetic CMIP6-like carbonate chemistry inputs for offline benchmarks
+
+Author: Sandy Herho
+Email: sandy.herho@email.ucr.edu
+Date: 06/14/2024
+"""
+
+import argparse
+import os
+
+import numpy as np
+import xarray as xr
+
+from extract_data import DATA_VARS, FILE_VARS, SCENARIOS, STATISTICS
+
+# Grid and time sizes: name -> (lat, lon, time steps per scenario)
+SIZES = {
+    'small': (180, 360, 10),
+    'medium': (360, 720, 20),
+    'large': (720, 1440, 40),
+}
+
+# Typical surface values and ranges of each data variable: (pre-industrial median, 2100 decline, spread)
+VARIABLE_LEVELS = {
+    'pHT': (8.17, 0.35, 0.03),
+    'aragonite': (3.4, 1.4, 0.3),
+    'calcite': (5.2, 2.1, 0.45),
+}
+
+def scenario_times(scenario, n_time):
+    """
+    Build the time axis of a scenario in years: up to 2010 for the historical run, 2020-2100 for the SSPs.
+    """
+    if scenario == 'historical':
+        return np.linspace(1750, 2010, n_time)
+    return np.linspace(2020, 2100, n_time)
+
+def make_scenario_files(root, scenario, n_lat, n_lon, n_time, seed=0):
+    """
+    Write the median and standard-deviation files of all variables of one scenario.
+
+    The files follow the layout of data/pre_processed/acid/{scenario}: one file per variable and
+    statistic named {FileVar}_{median|std}_{scenario}.nc, holding a (time, lat, lon) variable without
+    lat/lon coordinates and the 2D `latitude` and `longitude` variables. The land mask is the same
+    for all files.
+
+    Parameters:
+    - root: str, the directory receiving the scenario directories.
+    - scenario: str, the name of the scenario (e.g., 'historical', 'ssp119').
+    - n_lat, n_lon: int, the grid size.
+    - n_time: int, the number of time steps.
+    - seed: int, the seed of the random number generator.
+    """
+    rng = np.random.default_rng([seed, SCENARIOS.index(scenario)])
+    land = np.random.default_rng(seed).random((n_lat, n_lon)) < 0.25
+    lat = np.linspace(-90, 90, n_lat, endpoint=False) + 90 / n_lat
+    lon = np.linspace(20, 380, n_lon, endpoint=False) + 180 / n_lon
+    latitude, longitude = np.meshgrid(lat, lon, indexing='ij')
+    times = scenario_times(scenario, n_time)
+    progress = np.clip((times - 1850) / 250, 0, None)[:, None, None]
+    strength = 0.5 + SCENARIOS.index(scenario) / len(SCENARIOS)
+
+    os.makedirs(f"{root}/{scenario}", exist_ok=True)
+    for file_var, data_var in zip(FILE_VARS, DATA_VARS):
+        level, decline, spread = VARIABLE_LEVELS[data_var]
+        pattern = spread * np.cos(np.deg2rad(latitude))
+        for stat, stat_name in STATISTICS.items():
+            if stat == 'med':
+                values = level + pattern - decline * strength * progress ** 2
+                values = values + 0.01 * spread * rng.standard_normal((n_time, n_lat, n_lon))
+            else:
+                values = 0.1 * spread * (1 + rng.random((n_time, n_lat, n_lon)))
+            values[:, land] = np.nan
+            ds = xr.Dataset({data_var: (('time', 'lat', 'lon'), values),
+                             'longitude': (('lat', 'lon'), longitude),
+                             'latitude': (('lat', 'lon'), latitude)},
+                            coords={'time': times})
+            ds.to_netcdf(f"{root}/{scenario}/{file_var}_{stat_name}_{scenario}.nc")
+
+def make_dataset(root, size='small', scenarios=SCENARIOS, seed=0):
+    """
+    Write a synthetic input tree for all scenarios at one of the SIZES.
+
+    Returns:
+    - str, the root directory, usable as the base_path of extract_data.
+    """
+    n_lat, n_lon, n_time = SIZES[size]
+    for scenario in scenarios:
+        make_scenario_files(root, scenario, n_lat, n_lon, n_time, seed)
+    return root
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write synthetic inputs in the data/pre_processed/acid layout.")
+    parser.add_argument("root", help="directory receiving the scenario directories")
+    parser.add_argument("--size", choices=list(SIZES), default='small', help="grid and time size")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random number generator")
+    args = parser.parse_args()
+    make_dataset(args.root, args.size, seed=args.seed)
@@ -8,37 +8,46 @@ Author: Sandy Herho
 Email: sandy.herho@email.ucr.edu
 Date: 04/15/2024
 """
-import pandas as pd
-import matplotlib.pyplot as plt
+import instrument
+from figure_cache import pyplot
+from temporal_store import SCENARIOS, TemporalStore
 
 class ClimateDataPlotter:
     """
     A class to plot climate data including pH, aragonite, and calcite from different scenarios.
     
     Attributes:
-        data_paths (dict): Dictionary of file paths for each data scenario.
+        scenarios (dict): Dictionary of scenario names in the temporal store, keyed by label.
+        store (TemporalStore): Store holding the regional-mean time series.
         style (str): Matplotlib style to be used for plots.
         output_dir (str): Directory to save plots.
+        show (bool): Display each plot after saving it; if False the figure is closed instead, so batch
+            jobs never block on a display.
     """
-    def __init__(self, data_paths, style='bmh', output_dir='../figs/'):
+    def __init__(self, scenarios, store, style='bmh', output_dir='../figs/', show=True):
         """
-        Initializes the ClimateDataPlotter with paths to the data files, plot style, and output directory.
+        Initializes the ClimateDataPlotter with the scenarios, the temporal store, plot style, and output directory.
         """
-        self.data_paths = data_paths
+        self.scenarios = scenarios
+        self.store = store
         self.style = style
         self.output_dir = output_dir
-        plt.style.use(self.style)
+        self.show = show
 
     def load_data(self):
         """
-        Loads data from the specified paths and stores them in a dictionary.
+        Loads the data of each scenario from the temporal store and stores them in a dictionary.
         
         Returns:
             dict: A dictionary of dataframes for each scenario.
         """
-        return {key: pd.read_csv(path) for key, path in self.data_paths.items()}
+        data = {}
+        for key, scenario in self.scenarios.items():
+            with instrument.stage('load_data', 'temp_plot', scenario=scenario):
+                data[key] = self.store.frame(scenario)
+        return data
 
-    def plot_data(self, data, variable, variable_label):
+    def plot_data(self, data, variable, variable_label, bands=None):
         """
         Plots the given variable for all climate scenarios.
 
@@ -46,12 +55,21 @@ class ClimateDataPlotter:
             data (dict): A dictionary of pandas DataFrames containing the climate data.
             variable (str): The variable to plot (e.g., 'pH_med').
             variable_label (str): The label for the variable (for y-axis).
+            bands (dict): Optional Monte Carlo quantile bands keyed by scenario, as returned by
+                monte_carlo.load_bands. By default the bands are med +/- 1.96 std.
         """
+        plt = pyplot(self.style)
         fig, ax = plt.subplots()
         for scenario, df in data.items():
             ax.plot(df["time"], df[variable], label=scenario)
-            ax.fill_between(df["time"], df[variable] - 1.96*df[f"{variable[:-4]}_std"],
-                            df[variable] + 1.96*df[f"{variable[:-4]}_std"], alpha=0.2)
+            if bands is not None:
+                from monte_carlo import band_columns
+
+                lower, _, upper = band_columns(variable[:-4])
+                ax.fill_between(bands[scenario]["time"], bands[scenario][lower], bands[scenario][upper], alpha=0.2)
+            else:
+                ax.fill_between(df["time"], df[variable] - 1.96*df[f"{variable[:-4]}_std"],
+                                df[variable] + 1.96*df[f"{variable[:-4]}_std"], alpha=0.2)
         
         ax.set_xlabel("Time [Decades]", fontsize=18)
         ax.set_ylabel(variable_label, fontsize=18)
@@ -60,21 +78,22 @@ class ClimateDataPlotter:
         plt.xticks(fontsize=12)
         plt.yticks(fontsize=12)
         
-        plt.savefig(f'{self.output_dir}{variable}.png', dpi=450)
-        plt.show()
+        with instrument.stage('savefig', 'temp_plot', variable=variable):
+            plt.savefig(f'{self.output_dir}{variable}.png', dpi=450)
+        if self.show:
+            plt.show()
+        else:
+            plt.close(fig)
 
-# Example usage
-data_paths = {
-    "Historical": "../data/processed/temporal/historical.csv",
-    "SSP 1-1.9": "../data/processed/temporal/ssp119.csv",
-    "SSP 1-2.6": "../data/processed/temporal/ssp126.csv",
-    "SSP 2-4.5": "../data/processed/temporal/ssp245.csv",
-    "SSP 3-7.0": "../data/processed/temporal/ssp370.csv",
-    "SSP 5-8.5": "../data/processed/temporal/ssp585.csv"
-}
+def main(temporal_dir="../data/processed/temporal", figs_dir="../figs", show=True):
+    """
+    Plots the pH, aragonite and calcite time series of all scenarios.
+    """
+    plotter = ClimateDataPlotter(SCENARIOS, TemporalStore(temporal_dir), output_dir=f"{figs_dir}/", show=show)
+    data = plotter.load_data()
+    plotter.plot_data(data, 'pH_med', 'pH')
+    plotter.plot_data(data, 'aragonite_med', r'$\Omega_{\text{Aragonite}}$')
+    plotter.plot_data(data, 'calcite_med', r'$\Omega_{\text{Calcite}}$')
 
-plotter = ClimateDataPlotter(data_paths)
-data = plotter.load_data()
-plotter.plot_data(data, 'pH_med', 'pH')
-plotter.plot_data(data, 'aragonite_med', r'$\Omega_{\text{Aragonite}}$')
-plotter.plot_data(data, 'calcite_med', r'$\Omega_{\text{Calcite}}$')
\ No newline at end of file
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -8,109 +8,223 @@ Author: Sandy Herho
 Email: sandy.herho@email.ucr.edu
 Date: 03/29/2024
 """
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-import scipy.stats as stats
-from statsmodels.tsa.stattools import adfuller
-import scikit_posthocs as sp
-
-# Set visual style for all matplotlib plots
-plt.style.use("bmh")
-
-# Load data from CSV files
-def load_data(file_path, column_name):
-    return pd.read_csv(file_path)[column_name]
-
-# File paths for the datasets
-file_paths = {
-    'Historical': '../data/processed/temporal/historical.csv',
-    'SSP119': '../data/processed/temporal/ssp119.csv',
-    'SSP126': '../data/processed/temporal/ssp126.csv',
-    'SSP245': '../data/processed/temporal/ssp245.csv',
-    'SSP370': '../data/processed/temporal/ssp370.csv',
-    'SSP585': '../data/processed/temporal/ssp585.csv'
+
+import instrument
+from figure_cache import pyplot
+from rank_tests import dunn_matrix, rank_tests
+from temporal_store import TemporalStore
+
+# Scenario labels and their names in the temporal store
+scenarios = {
+    'Historical': 'historical',
+    'SSP119': 'ssp119',
+    'SSP126': 'ssp126',
+    'SSP245': 'ssp245',
+    'SSP370': 'ssp370',
+    'SSP585': 'ssp585'
 }
 
 # Load specified column for each scenario
-def load_datasets(file_paths, column_name):
-    return {scenario: load_data(path, column_name) for scenario, path in file_paths.items()}
+def load_datasets(store, scenarios, column_name):
+    return store.series(column_name, scenarios)
+
+# Columns of the table returned by analyze_all
+RESULT_COLUMNS = ['skew', 'kurtosis', 'shapiro_stat', 'shapiro_p', 'adf_stat', 'adf_p', 'adf_usedlag',
+                  'adf_crit_1%', 'adf_crit_5%', 'adf_crit_10%']
 
-# Statistical analysis function
-def analyze_data(data):
+# Results of analyze_data already computed in this process, keyed by analysis_key
+_analysis_cache = {}
+
+# Cache key from the values of a series and the test parameters
+def analysis_key(data, autolag, regression):
+    digest = hashlib.sha256(np.ascontiguousarray(data.to_numpy(dtype=np.float64)).tobytes())
+    digest.update(json.dumps({'autolag': autolag, 'regression': regression}).encode())
+    return digest.hexdigest()
+
+# Statistical analysis function, cached in memory and optionally in cache_dir
+def analyze_data(data, autolag='AIC', regression='c', cache_dir=None):
     data = data.dropna()  # Ensure no NA values interfere with calculations
-    skew = stats.skew(data)
-    kurt = stats.kurtosis(data, fisher=False)
+    key = analysis_key(data, autolag, regression)
+    if key in _analysis_cache:
+        return _analysis_cache[key]
+    cache_file = f"{cache_dir}/{key}.json" if cache_dir else None
+    if cache_file and os.path.exists(cache_file):
+        with open(cache_file) as f:
+            results = tuple(json.load(f))
+        _analysis_cache[key] = results
+        return results
+
+    # The test backends are only imported when a result is not cached
+    import scipy.stats as stats
+    from statsmodels.tsa.stattools import adfuller
+
+    skew = float(stats.skew(data))
+    kurt = float(stats.kurtosis(data, fisher=False))
     shapiro_stat, shapiro_p = stats.shapiro(data)
-    adf_stat, adf_p, usedlag, nobs, critical_values, icbest = adfuller(data)
-    return skew, kurt, shapiro_stat, shapiro_p, adf_stat, adf_p, critical_values
-
-# Display statistical results
-def display_results(scenario, results):
-    print(f"\nResults for {scenario}:")
-    skew, kurt, shapiro_stat, shapiro_p, adf_stat, adf_p, critical_values = results
-    print(f"  Skewness: {skew:.3f}")
-    print(f"  Kurtosis: {kurt:.3f}")
-    print(f"  Shapiro-Wilk Test: Statistic={shapiro_stat:.3f}, p-value={shapiro_p:.3f}")
-    print(f"  ADF Test: Statistic={adf_stat:.3f}, p-value={adf_p:.3f}, Critical Values={critical_values}")
-
-# Function to prepare data for statistical testing
-def prepare_data_for_testing(file_paths, column_name):
-    data = [load_data(path, column_name) for path in file_paths.values()]
-    labels = list(file_paths.keys())
-    data_stacked = np.concatenate(data)
-    groups = np.concatenate([[label] * len(d) for d, label in zip(data, labels)])
+    adf_stat, adf_p, usedlag, nobs, critical_values, icbest = adfuller(data, autolag=autolag,
+                                                                       regression=regression)
+    results = (skew, kurt, float(shapiro_stat), float(shapiro_p), float(adf_stat), float(adf_p),
+               {name: float(value) for name, value in critical_values.items()}, int(usedlag))
+
+    _analysis_cache[key] = results
+    if cache_file:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(f"{cache_file}.{os.getpid()}.tmp", 'w') as f:
+            json.dump(results, f)
+        os.replace(f"{cache_file}.{os.getpid()}.tmp", cache_file)
+    return results
+
+# Analyze one series and return a row of the results table
+def analyze_row(label, column_name, data, autolag='AIC', regression='c', cache_dir=None):
+    with instrument.stage('analyze_data', 'temp_stats', scenario=label, variable=column_name):
+        skew, kurt, shapiro_stat, shapiro_p, adf_stat, adf_p, critical_values, usedlag = analyze_data(
+            data, autolag=autolag, regression=regression, cache_dir=cache_dir)
+    row = {'scenario': label, 'variable': column_name, 'skew': skew, 'kurtosis': kurt,
+           'shapiro_stat': shapiro_stat, 'shapiro_p': shapiro_p, 'adf_stat': adf_stat, 'adf_p': adf_p,
+           'adf_usedlag': usedlag}
+    row.update({f'adf_crit_{name}': value for name, value in critical_values.items()})
+    return row
+
+# Analyze all scenario x variable combinations, optionally on a thread or process pool
+def analyze_all(store, scenarios, column_names, workers=1, executor='thread', autolag='AIC',
+                regression='c', cache_dir=None):
+    tasks = [(label, column_name, series)
+             for column_name in column_names
+             for label, series in load_datasets(store, scenarios, column_name).items()]
+    options = {'autolag': autolag, 'regression': regression, 'cache_dir': cache_dir}
+
+    if workers > 1:
+        if executor == 'process':
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        else:
+            pool = ThreadPoolExecutor(max_workers=workers)
+        with pool:
+            futures = [pool.submit(analyze_row, *task, **options) for task in tasks]
+            rows = [future.result() for future in futures]
+    else:
+        rows = [analyze_row(*task, **options) for task in tasks]
+    return pd.DataFrame(rows, columns=['scenario', 'variable'] + RESULT_COLUMNS)
+
+# Function to prepare the loaded data for statistical testing
+def prepare_data_for_testing(data):
+    labels = list(data.keys())
+    data_stacked = np.concatenate(list(data.values()))
+    groups = np.concatenate([[label] * len(d) for label, d in data.items()])
     return pd.DataFrame({'Value': data_stacked, 'Group': groups}), labels
 
-# Function to perform Kruskal-Wallis and Dunn's tests
-def perform_statistical_tests(df, labels, alpha=0.05):
+# Function to run Kruskal-Wallis and Dunn's tests for several variables at once
+def run_statistical_tests(store, scenarios, column_names, p_adjust='bonferroni'):
+    with instrument.stage('rank_tests', 'temp_stats', variables=list(column_names)):
+        return rank_tests({column_name: load_datasets(store, scenarios, column_name)
+                           for column_name in column_names}, p_adjust=p_adjust)
+
+# Function to report Kruskal-Wallis and Dunn's tests
+def perform_statistical_tests(tests, column_name, labels, alpha=0.05, show=True):
     # Kruskal-Wallis test
-    kw_stat, kw_pvalue = stats.kruskal(*[df[df['Group'] == label]['Value'] for label in labels])
+    results = tests[tests['variable'] == column_name]
+    kw_stat, kw_pvalue = results['H'].iloc[0], results['kw_pvalue'].iloc[0]
     print(f'Kruskal-Wallis test statistic: {kw_stat:.3f}, p-value: {kw_pvalue:.3f}')
 
     if kw_pvalue < alpha:
         print("Significant differences found among the groups.")
-        # Dunn's post-hoc test with Bonferroni adjustment
-        dunn_pvalues = sp.posthoc_dunn(df, val_col='Value', group_col='Group', p_adjust='bonferroni')
+        # Dunn's post-hoc test, adjusted for multiple comparisons
+        dunn_pvalues = dunn_matrix(tests, column_name, labels)
         print(dunn_pvalues.round(3))
-        # Plot heatmap of Dunn's test results
-        plt.figure(figsize=(10, 8))
-        sns.heatmap(dunn_pvalues, cmap='coolwarm_r', xticklabels=labels, yticklabels=labels)
-        plt.show()
+        # Show a heatmap of Dunn's test results in interactive runs
+        if show:
+            import seaborn as sns
+
+            plt = pyplot()
+            fig = plt.figure(figsize=(10, 8))
+            sns.heatmap(dunn_pvalues, cmap='coolwarm_r', xticklabels=labels, yticklabels=labels)
+            plt.show()
+            plt.close(fig)
 
 # Function to plot boxplots
 def plot_results(df, labels, filename):
-    plt.figure(figsize=(10, 8))
+    import seaborn as sns
+
+    plt = pyplot()
+    fig = plt.figure(figsize=(10, 8))
     sns.boxplot(x='Group', y='Value', data=df)
     plt.xticks(ticks=np.arange(len(labels)), labels=labels, rotation=45)
     plt.savefig(filename)
+    plt.close(fig)
 
 # Prepare and plot data
-def prepare_and_plot_data(file_paths, column_name, file_prefix):
-    data = load_datasets(file_paths, column_name)
-    for scenario, dataset in data.items():
-        results = analyze_data(dataset)
-        display_results(scenario, results)
-    df, labels = prepare_data_for_testing(file_paths, column_name)
-    perform_statistical_tests(df, labels)
-    plot_results(df, labels, f'../figs/{file_prefix}_boxplot.png')
-    plot_density(data, labels, f'../figs/{file_prefix}_density.png')
+def prepare_and_plot_data(store, scenarios, column_name, file_prefix, tests=None, figs_dir='../figs', show=True):
+    data = load_datasets(store, scenarios, column_name)
+    df, labels = prepare_data_for_testing(data)
+    if tests is None:
+        tests = rank_tests({column_name: data})
+    perform_statistical_tests(tests, column_name, labels, show=show)
+    with instrument.stage('plots', 'temp_stats', variable=column_name):
+        plot_results(df, labels, f'{figs_dir}/{file_prefix}_boxplot.png')
+        plot_density(data, labels, f'{figs_dir}/{file_prefix}_density.png')
 
 # Plot density for each scenario
 def plot_density(data, labels, filename):
-    plt.figure(figsize=(10, 8))
+    import seaborn as sns
+
+    plt = pyplot()
+    fig = plt.figure(figsize=(10, 8))
     for label, dataset in data.items():
         sns.kdeplot(dataset.dropna(), label=label)
     plt.legend()
     plt.savefig(filename)
+    plt.close(fig)
+
+# Statistics, rank tests and plots of all variables
+def main(temporal_dir='../data/processed/temporal', figs_dir='../figs', workers=1, executor='thread',
+         cache_dir=None, show=True):
+    # The descriptive statistics are cached next to the series they summarize
+    if cache_dir is None:
+        cache_dir = f'{temporal_dir}/stats_cache'
+    # Each scenario file is parsed at most once and shared by all variables
+    store = TemporalStore(temporal_dir)
+
+    # Descriptive statistics and rank tests for all variables in one pass
+    column_names = ['aragonite_med', 'calcite_med', 'pH_med']
+    table = analyze_all(store, scenarios, column_names, workers=workers, executor=executor,
+                        cache_dir=cache_dir)
+    tests = run_statistical_tests(store, scenarios, column_names)
+    print(table.to_string(index=False))
 
-if __name__ == "__main__":
     # Analyze and plot for 'aragonite_med'
-    prepare_and_plot_data(file_paths, 'aragonite_med', 'aragonite_med')
+    prepare_and_plot_data(store, scenarios, 'aragonite_med', 'aragonite_med', tests, figs_dir, show)
 
     # Analyze and plot for 'calcite_med'
-    prepare_and_plot_data(file_paths, 'calcite_med', 'calcite_med')
+    prepare_and_plot_data(store, scenarios, 'calcite_med', 'calcite_med', tests, figs_dir, show)
 
     # Analyze and plot for 'pH_med'
-    prepare_and_plot_data(file_paths, 'pH_med', 'pH_med')
\ No newline at end of file
+    prepare_and_plot_data(store, scenarios, 'pH_med', 'pH_med', tests, figs_dir, show)
+    return table
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Temporal statistics of the regional-mean time series.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of workers evaluating the scenario x variable statistics")
+    parser.add_argument("--executor", choices=["thread", "process"], default="thread",
+                        help="run the workers as threads or processes")
+    parser.add_argument("--cache-dir", default=None,
+                        help="directory caching the descriptive statistics between runs "
+                             "(default: stats_cache in the temporal directory)")
+    parser.add_argument("--headless", action="store_true",
+                        help="render with the Agg backend and save the figures without displaying them")
+    parser.add_argument("--trace", metavar="JSON", default=None,
+                        help="record the time and memory of each stage to a Chrome-trace file")
+    args = parser.parse_args()
+    if args.trace:
+        instrument.enable(args.trace)
+    if args.headless:
+        pyplot().switch_backend("Agg")
+    main(workers=args.workers, executor=args.executor, cache_dir=args.cache_dir, show=not args.headless)
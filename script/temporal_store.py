@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+"""
+temporal_store.py
+Columnar, memory-mapped store for the regional-mean time series
+
+Author: Sandy Herho
+Email: sandy.herho@email.ucr.edu
+Date: 05/10/2024
+"""
+
+import fcntl
+import json
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+# Label -> scenario name, in plotting order
+SCENARIOS = {
+    'Historical': 'historical',
+    'SSP 1-1.9': 'ssp119',
+    'SSP 1-2.6': 'ssp126',
+    'SSP 2-4.5': 'ssp245',
+    'SSP 3-7.0': 'ssp370',
+    'SSP 5-8.5': 'ssp585'
+}
+
+def write_scenario(df, temporal_dir, scenario, store_dir=None):
+    """
+    Write the time series of a scenario to the columnar store.
+
+    Each scenario is stored as a (column, time) float64 array in `{store_dir}/{scenario}.npy`, so every
+    column is a contiguous block that can be memory-mapped without copying. The column names are kept
+    in `{store_dir}/index.json`.
+
+    Several processes may write and read the store at the same time: the array is written to a
+    temporary file and moved into place, so readers never map a partial file, and the index is
+    updated under a lock, so concurrent writers do not drop each other's entries.
+
+    Parameters:
+    - df: pandas DataFrame with the numeric columns of the scenario.
+    - temporal_dir: str, the directory holding the temporal products.
+    - scenario: str, the name of the scenario (e.g., 'historical', 'ssp119').
+    - store_dir: str, the directory of the store (default: `{temporal_dir}/store`).
+    """
+    store_dir = store_dir or f"{temporal_dir}/store"
+    os.makedirs(store_dir, exist_ok=True)
+    replace_atomically(f"{store_dir}/{scenario}.npy",
+                       lambda f: np.save(f, np.ascontiguousarray(df.to_numpy(dtype=np.float64).T)))
+
+    index_path = f"{store_dir}/index.json"
+    with open(f"{index_path}.lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            index = {}
+        index[scenario] = [str(column) for column in df.columns]
+        replace_atomically(index_path, lambda f: f.write(json.dumps(index, indent=2, sort_keys=True).encode()))
+
+def replace_atomically(path, write):
+    """
+    Write a file through a uniquely named temporary file in the same directory and move it into place.
+
+    Parameters:
+    - path: str, the file to (re)place.
+    - write: function of the open binary temporary file, writing its content.
+    """
+    # Unique per process and thread; unlike mkstemp, the file gets the permissions of the umask
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        # The temporary file may not exist, e.g. when open failed; keep the original error either way
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+class TemporalStore:
+    """
+    Read access to the regional-mean time series, keyed by scenario and variable.
+
+    Scenarios are memory-mapped from the columnar store. A scenario whose store entry is missing or
+    older than its CSV file is parsed from the CSV once and written to the store. Without a cache,
+    the CSV files are parsed into memory and nothing is written, as for input directories the
+    pipeline does not own.
+
+    Attributes:
+        temporal_dir (str): Directory holding the `{scenario}.csv` files.
+        store_dir (str): Directory of the columnar store, or None to keep the tables in memory only.
+    """
+
+    def __init__(self, temporal_dir='../data/processed/temporal', store_dir=None, cache=True):
+        """
+        Initializes the store for a temporal data directory.
+
+        Parameters:
+            temporal_dir (str): Directory holding the `{scenario}.csv` files.
+            store_dir (str): Directory of the columnar store. Default is `{temporal_dir}/store`.
+            cache (bool): If False, never read or write a store. Default is True.
+        """
+        self.temporal_dir = temporal_dir
+        self.store_dir = (store_dir or f"{temporal_dir}/store") if cache else None
+        self._tables = {}
+        self._columns = {}
+
+    def _load(self, scenario):
+        """
+        Memory-maps a scenario, (re)building its store entry from the CSV file if needed.
+        """
+        csv_path = f"{self.temporal_dir}/{scenario}.csv"
+        if self.store_dir is None:
+            df = pd.read_csv(csv_path)
+            self._tables[scenario] = np.ascontiguousarray(df.to_numpy(dtype=np.float64).T)
+            self._columns[scenario] = list(df.columns)
+            return
+
+        npy_path = f"{self.store_dir}/{scenario}.npy"
+        try:
+            with open(f"{self.store_dir}/index.json") as f:
+                columns = json.load(f).get(scenario)
+        except (FileNotFoundError, json.JSONDecodeError):
+            columns = None
+
+        stale = (columns is None or not os.path.exists(npy_path) or
+                 (os.path.exists(csv_path) and os.path.getmtime(csv_path) > os.path.getmtime(npy_path)))
+        if stale:
+            df = pd.read_csv(csv_path)
+            try:
+                write_scenario(df, self.temporal_dir, scenario, self.store_dir)
+            except OSError:
+                # Read-only data directory: keep the parsed table in memory
+                self._tables[scenario] = np.ascontiguousarray(df.to_numpy(dtype=np.float64).T)
+                self._columns[scenario] = list(df.columns)
+                return
+            columns = list(df.columns)
+
+        self._tables[scenario] = np.load(npy_path, mmap_mode='r')
+        self._columns[scenario] = columns
+
+    def columns(self, scenario):
+        """
+        Returns the column names of a scenario.
+        """
+        if scenario not in self._tables:
+            self._load(scenario)
+        return self._columns[scenario]
+
+    def column(self, scenario, variable):
+        """
+        Returns one column of a scenario as a read-only view on the memory-mapped store.
+
+        Parameters:
+            scenario (str): The name of the scenario (e.g., 'historical', 'ssp119').
+            variable (str): The column to return (e.g., 'pH_med').
+
+        Returns:
+            numpy.ndarray: The column values, without copying.
+        """
+        columns = self.columns(scenario)
+        if variable not in columns:
+            raise KeyError(f"{variable!r} is not a column of {scenario!r}: {columns}")
+        return self._tables[scenario][columns.index(variable)]
+
+    def frame(self, scenario):
+        """
+        Returns all columns of a scenario as a pandas DataFrame.
+        """
+        columns = self.columns(scenario)
+        return pd.DataFrame({name: self._tables[scenario][i] for i, name in enumerate(columns)})
+
+    def series(self, variable, scenarios=SCENARIOS):
+        """
+        Returns one variable for several scenarios.
+
+        Parameters:
+            variable (str): The column to return (e.g., 'pH_med').
+            scenarios (dict): Mapping of labels to scenario names. Default is all scenarios.
+
+        Returns:
+            dict: A dictionary of pandas Series keyed by label.
+        """
+        return {label: pd.Series(self.column(scenario, variable), name=variable, copy=False)
+                for label, scenario in scenarios.items()}
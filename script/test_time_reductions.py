@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+"""
+test_time_reductions.py
+Tests of the out-of-core reductions over time
+
+Author: Sandy Herho
+Email: sandy.herho@email.ucr.edu
+Date: 06/24/2024
+"""
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from time_reductions import REDUCTIONS, reduce_time
+
+def make_field(dtype='float64'):
+    """
+    Build a small in-memory (time, lat, lon) field with missing values, including an all-missing cell.
+    """
+    rng = np.random.default_rng(0)
+    values = rng.normal(8.0, 0.1, size=(12, 4, 5)).astype(dtype)
+    values[rng.random(values.shape) < 0.2] = np.nan
+    values[:, 0, 0] = np.nan
+    return xr.DataArray(values, dims=('time', 'lat', 'lon'),
+                        coords={'time': 1850.0 + np.arange(12)}, name='pHT')
+
+@pytest.mark.parametrize('reduction', REDUCTIONS)
+def test_reduce_time_leaves_input_unchanged(reduction):
+    data = make_field()
+    before = data.copy(deep=True)
+    # A small block forces several blocks of time steps or rows
+    reduce_time(data, reduction, percentile=90, block_bytes=64)
+    xr.testing.assert_identical(data, before)
+
+@pytest.mark.parametrize('dtype', ['float64', 'float32'])
+def test_time_mean_matches_nanmean(dtype):
+    data = make_field(dtype)
+    with np.errstate(invalid='ignore'), pytest.warns(RuntimeWarning):
+        expected = np.nanmean(data.to_numpy().astype('float64'), axis=0).astype(dtype)
+    result = reduce_time(data, 'mean', block_bytes=64)
+    assert result.dtype == dtype
+    np.testing.assert_allclose(result.to_numpy(), expected, rtol=1e-6, equal_nan=True)
+
+def test_time_percentile_matches_nanpercentile():
+    data = make_field()
+    with pytest.warns(RuntimeWarning):
+        expected = np.nanpercentile(data.to_numpy(), 90, axis=0)
+    result = reduce_time(data, 'percentile', percentile=90, block_bytes=64)
+    np.testing.assert_allclose(result.to_numpy(), expected, equal_nan=True)
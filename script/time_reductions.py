@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+"""
+time_reductions.py
+Out-of-core reductions of spatial products over time
+
+Author: Sandy Herho
+Email: sandy.herho@email.ucr.edu
+Date: 06/21/2024
+"""
+
+import argparse
+import warnings
+
+import numpy as np
+import xarray as xr
+
+# Reductions over the time axis; 'percentile' takes the percentile in [0, 100] as a separate argument
+REDUCTIONS = ['mean', 'median', 'percentile']
+
+# Approximate number of bytes of input read from disk at a time
+BLOCK_BYTES = 1 << 26
+
+def select_time(data, time):
+    """
+    Select a single time step, reading only that slice from a lazily opened product.
+
+    Parameters:
+    - data: xarray DataArray with a time dimension.
+    - time: the time to select. On the decimal-year axes of the products a year such as 2100 or
+      "2100" selects that time step; datetime axes also accept a date string.
+
+    Returns:
+    - xarray DataArray without the time dimension, still lazy.
+    """
+    if np.issubdtype(data['time'].dtype, np.number):
+        return data.sel(time=float(time))
+    return data.sel(time=time)
+
+def time_mean(data, block_bytes=BLOCK_BYTES):
+    """
+    Average over time, skipping NaNs, by accumulating sums and counts over blocks of time steps.
+
+    At most `block_bytes` of input and two float64 accumulators of one time step are held in memory.
+
+    Parameters:
+    - data: xarray DataArray (time, ...), opened lazily.
+    - block_bytes: int, the approximate number of input bytes read at a time.
+
+    Returns:
+    - xarray DataArray without the time dimension; NaN where all time steps are missing.
+    """
+    data = data.transpose('time', ...)
+    template = data.isel(time=0, drop=True)
+    step = max(1, block_bytes // max(1, template.size * data.dtype.itemsize))
+    total = np.zeros(template.shape)
+    count = np.zeros(template.shape)
+    for start in range(0, data.sizes['time'], step):
+        block = data.isel(time=slice(start, start + step)).to_numpy()
+        count += block.shape[0] - np.isnan(block).sum(axis=0)
+        # In-memory arrays hand out views of their data, so the block is summed without being modified
+        total += np.nansum(block, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (total / count).astype(data.dtype)
+    return template.copy(data=mean)
+
+def time_percentile(data, percentile, block_bytes=BLOCK_BYTES):
+    """
+    Take a percentile over time, skipping NaNs, for blocks of rows of the grid.
+
+    Order statistics need every time step of a cell, so the grid is split along its first spatial
+    dimension instead, and each block of rows is read with its full time axis.
+
+    Parameters:
+    - data: xarray DataArray (time, ...), opened lazily.
+    - percentile: float in [0, 100]; 50 gives the median.
+    - block_bytes: int, the approximate number of input bytes read at a time.
+
+    Returns:
+    - xarray DataArray without the time dimension; NaN where all time steps are missing.
+    """
+    data = data.transpose('time', ...)
+    template = data.isel(time=0, drop=True)
+    if not template.dims:
+        return template.copy(data=np.nanpercentile(data.to_numpy(), percentile))
+    dim = template.dims[0]
+    row_bytes = data.sizes['time'] * (template.size // template.sizes[dim]) * data.dtype.itemsize
+    step = max(1, block_bytes // max(1, row_bytes))
+    result = np.empty(template.shape, dtype=data.dtype)
+    for start in range(0, template.sizes[dim], step):
+        block = data.isel({dim: slice(start, start + step)}).to_numpy()
+        with warnings.catch_warnings():
+            # All-missing cells, e.g. land, stay NaN
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            result[start:start + step] = np.nanpercentile(block, percentile, axis=0)
+    return template.copy(data=result)
+
+def reduce_time(data, reduction='mean', percentile=None, block_bytes=BLOCK_BYTES):
+    """
+    Reduce a lazily opened product over time with bounded memory.
+
+    Parameters:
+    - data: xarray DataArray (time, ...).
+    - reduction: str, one of REDUCTIONS.
+    - percentile: float in [0, 100], required for the 'percentile' reduction.
+    - block_bytes: int, the approximate number of input bytes read at a time.
+
+    Returns:
+    - xarray DataArray without the time dimension.
+    """
+    if reduction == 'mean':
+        return time_mean(data, block_bytes)
+    if reduction == 'median':
+        return time_percentile(data, 50, block_bytes)
+    if reduction == 'percentile':
+        if percentile is None:
+            raise ValueError("The 'percentile' reduction needs a percentile in [0, 100]")
+        return time_percentile(data, percentile, block_bytes)
+    raise ValueError(f"Unknown time reduction {reduction!r}, expected one of {REDUCTIONS}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reduce a spatial product over time with bounded memory.")
+    parser.add_argument("input", help="NetCDF file holding the product")
+    parser.add_argument("variable", help="variable to reduce, e.g. pHT")
+    parser.add_argument("output", help="NetCDF file receiving the reduced field")
+    parser.add_argument("--reduction", choices=REDUCTIONS, default='mean', help="reduction over time")
+    parser.add_argument("--percentile", type=float, default=None, help="percentile of the 'percentile' reduction")
+    parser.add_argument("--block-mb", type=float, default=BLOCK_BYTES / 1024 ** 2,
+                        help="approximate megabytes of input read at a time")
+    args = parser.parse_args()
+
+    with xr.open_dataset(args.input) as ds:
+        reduced = reduce_time(ds[args.variable], args.reduction, args.percentile, int(args.block_mb * 1024 ** 2))
+        reduced.to_dataset(name=args.variable).to_netcdf(args.output)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+"""
+trend_maps.py
+Per-grid-cell Sen slope and Mann-Kendall trend maps
+
+Author: Sandy Herho
+Email: sandy.herho@email.ucr.edu
+Date: 05/20/2024
+"""
+
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import xarray as xr
+
+from extract_data import (DATA_VARS, FILE_VARS, SCENARIO_PREFIXES, SCENARIOS, VARIABLE_PREFIXES,
+                          product_path)
+from spa_plot import load_and_select_data
+
+# Approximate memory budget of one block of cells, in bytes
+BLOCK_BYTES = 1 << 28
+
+# Float64 arrays of (pairs, cells) alive at the same time in sen_mann_kendall: the differences and the
+# temporaries of the sign and of the median
+PAIR_ARRAYS = 3
+
+def block_cells(n_time, block_bytes=BLOCK_BYTES):
+    """
+    Choose the number of grid cells per block so the pairwise differences of a block fit the budget.
+
+    The pairwise arrays hold n_time * (n_time - 1) / 2 values per cell, so the block shrinks
+    quadratically with the length of the series.
+
+    Parameters:
+    - n_time: int, the number of time steps.
+    - block_bytes: int, the approximate memory budget of one block.
+
+    Returns:
+    - int, the number of cells per block, at least 1.
+    """
+    pairs = max(1, n_time * (n_time - 1) // 2)
+    return max(1, block_bytes // (PAIR_ARRAYS * pairs * np.dtype(np.float64).itemsize))
+
+def sen_mann_kendall(values, time):
+    """
+    Sen slope and Mann-Kendall test for a block of time series, vectorized over all pairs of time steps.
+
+    Parameters:
+    - values: 2D numpy array (time, cells).
+    - time: 1D numpy array with the time of each step, e.g. in years.
+
+    Returns:
+    - dict of 1D arrays (cells,): 'slope' (Sen slope per unit of time), 'tau' (Kendall's tau),
+      'z' and 'p_value' (two-sided Mann-Kendall test without tie correction). Cells with fewer
+      than three valid time steps are NaN.
+    """
+    import scipy.stats as stats
+
+    n = np.sum(~np.isnan(values), axis=0).astype(float)
+    valid = n >= 3
+    result = {key: np.full(values.shape[1], np.nan) for key in ('slope', 'tau', 'z', 'p_value')}
+    if not valid.any():
+        return result
+
+    first, second = np.triu_indices(len(time), k=1)
+    series = values[:, valid]
+    diffs = series[second] - series[first]
+    s = np.nansum(np.sign(diffs), axis=0)
+    # The differences are turned into slopes in place, so only one (pairs, cells) array is kept
+    slopes = np.divide(diffs, (time[second] - time[first])[:, None], out=diffs)
+    n = n[valid]
+    variance = n * (n - 1) * (2 * n + 5) / 18.0
+    z = np.where(s > 0, s - 1, np.where(s < 0, s + 1, 0.0)) / np.sqrt(variance)
+
+    result['slope'][valid] = np.nanmedian(slopes, axis=0)
+    result['tau'][valid] = s / (n * (n - 1) / 2.0)
+    result['z'][valid] = z
+    result['p_value'][valid] = 2 * stats.norm.sf(np.abs(z))
+    return result
+
+def trend_map(data, executor=None, block_size=None, block_bytes=BLOCK_BYTES):
+    """
+    Compute Sen slope and Mann-Kendall maps of a (time, lat, lon) field.
+
+    The grid is flattened to (time, cell) and processed in blocks of cells, optionally on a process pool.
+
+    Parameters:
+    - data: xarray DataArray with dims (time, lat, lon) and a numeric time coordinate.
+    - executor: concurrent.futures executor computing the blocks; None computes them serially. The
+      executor is reused across calls, so a process pool is only started once per run.
+    - block_size: int, the number of grid cells per block (default: derived from block_bytes and
+      the length of the series with block_cells).
+    - block_bytes: int, the approximate memory budget of one block, per worker.
+
+    Returns:
+    - xarray Dataset with 'slope', 'tau', 'z' and 'p_value' on the (lat, lon) grid.
+    """
+    time = data["time"].to_numpy().astype(float)
+    values = data.transpose("time", "lat", "lon").to_numpy().reshape(len(time), -1)
+    block_size = block_size or block_cells(len(time), block_bytes)
+    blocks = [values[:, start:start + block_size] for start in range(0, values.shape[1], block_size)]
+
+    if executor is not None:
+        results = list(executor.map(sen_mann_kendall, blocks, [time] * len(blocks)))
+    else:
+        results = [sen_mann_kendall(block, time) for block in blocks]
+
+    shape = data.sizes["lat"], data.sizes["lon"]
+    trends = xr.Dataset({key: (("lat", "lon"), np.concatenate([r[key] for r in results]).reshape(shape))
+                         for key in results[0]})
+    trends["slope"].attrs["long_name"] = f"Sen slope of {data.name} per unit of time"
+    trends["tau"].attrs["long_name"] = "Kendall's tau"
+    trends["z"].attrs["long_name"] = "Mann-Kendall test statistic"
+    trends["p_value"].attrs["long_name"] = "Two-sided Mann-Kendall p-value"
+    return trends
+
+def main(workers=1, output_format="netcdf", data_root="../data", block_size=None, block_bytes=BLOCK_BYTES):
+    base_path = f"{data_root}/processed/spa"
+
+    # One pool serves every product; spawned workers avoid forking after HDF5 has been initialised
+    executor = None
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        for file_var, variable in zip(FILE_VARS, DATA_VARS):
+            for scenario in SCENARIOS:
+                path, group = product_path(base_path, scenario, file_var, "med", output_format)
+                data = load_and_select_data(path, variable, group=group)
+                trends = trend_map(data, executor=executor, block_size=block_size, block_bytes=block_bytes)
+                # The grid is curvilinear, so the 2D coordinates travel with the maps
+                for coord in ("latitude", "longitude"):
+                    trends[coord] = load_and_select_data(path, coord, group=group)
+                suffix = SCENARIO_PREFIXES.get(scenario, scenario)
+                prefix = VARIABLE_PREFIXES[file_var]
+                trends.to_netcdf(f"{base_path}/{suffix}_{prefix}_trend.nc")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute per-grid-cell trend maps of the spatial products.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes used for the spatial blocks")
+    parser.add_argument("--format", dest="output_format", choices=["netcdf", "zarr"], default="netcdf",
+                        help="storage of the spatial products written by extract_data")
+    parser.add_argument("--data-root", default="../data",
+                        help="data directory holding processed/spa")
+    parser.add_argument("--block-size", type=int, default=None,
+                        help="grid cells per block (default: derived from --block-mb and the series length)")
+    parser.add_argument("--block-mb", type=float, default=BLOCK_BYTES / 1024 ** 2,
+                        help="approximate memory budget of one block of cells, per worker")
+    args = parser.parse_args()
+    main(workers=args.workers, output_format=args.output_format, data_root=args.data_root,
+         block_size=args.block_size, block_bytes=int(args.block_mb * 1024 ** 2))